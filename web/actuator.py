@@ -0,0 +1,157 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+ACTIVATE = "activate"
+OPEN = "open"
+DEACTIVATE = "deactivate"
+DEACTIVATE_ALL = "deactivate_all"
+
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+
+class Actuator:
+    """Single worker thread that owns the pin controller.
+
+    Web requests and the scheduler queue commands instead of switching
+    relays themselves, so GPIO writes never interleave and callers don't
+    wait on the hardware. Commands queued within ``COALESCE_WINDOW`` seconds
+    of each other are folded into one final set of pin states and written
+    with a single ``set_lines`` call.
+
+    Each command returns a ``Future`` that resolves to the list of pins that
+    changed, or ``False`` if the pin is not in the controller's PINLIST.
+    """
+
+    COALESCE_WINDOW = 0.02
+
+    def __init__(self, controller):
+        self.controller = controller
+        self._queue = queue.Queue()
+        self._thread = None
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """Call ``callback({pin: active})`` with the pins each write changed."""
+        self._subscribers.append(callback)
+
+    def activate_line(self, pin: int):
+        return self.submit(ACTIVATE, pin)
+
+    def open_line(self, pin: int):
+        """Activate ``pin`` and leave every other line as it is."""
+        return self.submit(OPEN, pin)
+
+    def deactivate_line(self, pin: int):
+        return self.submit(DEACTIVATE, pin)
+
+    def deactivate_all_lines(self):
+        return self.submit(DEACTIVATE_ALL)
+
+    def submit(self, action, pin=None):
+        future = Future()
+        self._queue.put((action, pin, future))
+        return future
+
+    def _collect(self):
+        """Block for one command, then gather any that follow it closely."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.COALESCE_WINDOW
+        while batch[-1] is not _STOP:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _apply(self, batch):
+        pins = self.controller.PINLIST
+        states = self.controller.get_pin_states()
+        accepted = []
+        for action, pin, future in batch:
+            if action != DEACTIVATE_ALL and pin not in pins:
+                logger.error(
+                    f"Can't {action} pin {pin}, not in the pin list",
+                    extra={"pin": pin, "action": action},
+                )
+                future.set_result(False)
+                continue
+            if action == ACTIVATE:
+                # Only one line waters at a time
+                states = {every_pin: False for every_pin in pins}
+                states[pin] = True
+            elif action == OPEN:
+                states[pin] = True
+            elif action == DEACTIVATE:
+                states[pin] = False
+            elif action == DEACTIVATE_ALL:
+                states = {every_pin: False for every_pin in pins}
+            accepted.append(future)
+
+        if not accepted:
+            return
+        try:
+            changed = self.controller.set_lines(states)
+        except Exception as e:
+            for future in accepted:
+                future.set_exception(e)
+        else:
+            for future in accepted:
+                future.set_result(changed)
+            if changed:
+                transitions = {pin: states[pin] for pin in changed}
+                for callback in self._subscribers:
+                    # A failing subscriber mustn't stop relay control
+                    try:
+                        callback(transitions)
+                    except Exception:
+                        logger.exception(f"Valve change subscriber {callback!r} failed")
+
+    def drain(self):
+        """Apply every queued command now, on the calling thread.
+
+        For driving the actuator without its worker, e.g. in simulations.
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._apply(batch)
+
+    def run(self):
+        while True:
+            batch = self._collect()
+            stopping = batch[-1] is _STOP
+            if stopping:
+                batch.pop()
+            if batch:
+                try:
+                    self._apply(batch)
+                except Exception as e:
+                    # E.g. reading the pin states failed, keep the worker alive
+                    logger.exception("Applying relay commands failed")
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+            if stopping:
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Apply everything already queued, then stop the worker."""
+        self._queue.put(_STOP)
+        if self._thread:
+            self._thread.join()
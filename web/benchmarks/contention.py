@@ -0,0 +1,407 @@
+"""Concurrent reads and writes while the scheduler fires dense schedules.
+
+Reproduces "database is locked" errors and late valve switching off the
+Pi. A fresh temporary database is seeded with ``--lines`` lines that each
+water every other minute for the length of the run, and served with the
+dummy pin controller by main.py, or by controller.py and gunicorn with
+``--workers``. ``--clients`` client processes, each owning a line of its
+own, then mix list page reads with schedule creates, edits and deletes,
+line edits and maintenance toggles.
+
+Reports latency percentiles and error rates per kind of request, and from
+the server's /metrics the SQLite statements retried or given up on a
+locked database and how late scheduler jobs fired. With ``--workers`` the
+SQLite counts are the controller's, writes made by the web workers
+themselves aren't included.
+
+Run from the ``web`` directory, for long enough to span a few minutes:
+
+    python -m benchmarks.contention --clients 32 --duration 150
+    python -m benchmarks.contention --workers 4 --output after.json
+"""
+
+import argparse
+import collections
+import datetime
+import http.client
+import json
+import math
+import multiprocessing
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from benchmarks.workers import PORT, serve, server_env
+from pins import PINLIST
+from utils import DAYS, minute_to_time
+
+# Kinds of request and how often each client picks them
+MIX = [
+    ("read_schedules", 4),
+    ("read_lines", 4),
+    ("read_status", 2),
+    ("create_schedule", 3),
+    ("edit_schedule", 2),
+    ("delete_schedule", 2),
+    ("edit_line", 1),
+    ("toggle_maintenance", 1),
+]
+
+DENSE_PIN = 2000
+CLIENT_PIN = 3000
+
+SAMPLE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def seed_dense(file, lines, clients, start, minutes):
+    """Lines watering every other minute from the minute after ``start``
+    for ``minutes``, and a line for each client. Returns the client lines'
+    ids."""
+    from createdb import migrate
+
+    migrate(file)
+    conn = sqlite3.connect(file)
+    # The relay board's pins first, the actuator refuses to switch the rest
+    # but their runs are still dispatched and recorded
+    dense_pins = sorted(PINLIST) + [DENSE_PIN + index for index in range(lines)]
+    conn.executemany(
+        "INSERT INTO watering_lines (name, gpio_pin) VALUES (?, ?)",
+        [(f"Dense {index}", dense_pins[index]) for index in range(lines)]
+        + [(f"Load {number}", CLIENT_PIN + number) for number in range(clients)],
+    )
+    ids = [row[0] for row in conn.execute("SELECT id FROM watering_lines ORDER BY id")]
+    schedules = []
+    for offset in range(1, minutes + 1):
+        moment = start + datetime.timedelta(minutes=offset)
+        minute = moment.hour * 60 + moment.minute
+        for index in range(lines):
+            # Half the lines start and the other half stop every minute
+            if (offset + index) % 2 == 0:
+                schedules.append(
+                    (ids[index], minute, (minute + 1) % (24 * 60), 1 << moment.weekday())
+                )
+    conn.executemany(
+        """
+        INSERT INTO watering_schedule
+            (watering_line_id, start_minute, end_minute, repeat_days)
+        VALUES (?, ?, ?, ?)
+        """,
+        schedules,
+    )
+    # Every line can water at once, so runs start on time rather than queue
+    conn.execute(
+        "INSERT OR REPLACE INTO settings (key, value) VALUES ('supply_capacity', ?)",
+        (str(lines + clients),),
+    )
+    conn.commit()
+    conn.close()
+    return ids[lines:]
+
+
+class Client:
+    """One simulated user, working on the schedules of its own line."""
+
+    def __init__(self, port, number, line_id, day):
+        self.port = port
+        self.number = number
+        self.line_id = line_id
+        # A day none of the dense schedules use, so edits don't fire
+        self.day = day
+        self.random = random.Random(number)
+        self.schedule_ids = []
+        self.own_rows = re.compile(
+            rf"<td>Load {number}</td>.*?/schedules/edit/(\d+)", re.DOTALL
+        )
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.defaultdict(collections.Counter)
+
+    def send(self, kind, method, path, fields=None):
+        body, headers = None, {}
+        if fields is not None:
+            body = urllib.parse.urlencode(fields, doseq=True)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        started = time.perf_counter()
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            text = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.outcomes[kind]["error"] += 1
+            return None, None
+        self.latencies[kind].append(time.perf_counter() - started)
+        if response.status >= 500:
+            outcome = "error"
+        elif response.status >= 400:
+            # Conflicting times, or a schedule another request deleted
+            outcome = "rejected"
+        else:
+            outcome = "ok"
+        self.outcomes[kind][outcome] += 1
+        return response.status, text
+
+    def schedule_fields(self):
+        start_minute = self.random.randrange(0, 24 * 60 - 30)
+        return {
+            "watering_line_id": self.line_id,
+            "start_time": minute_to_time(start_minute),
+            "end_time": minute_to_time(start_minute + self.random.randint(1, 30)),
+            "repeat_days": [DAYS[self.day]],
+        }
+
+    def step(self, kind):
+        if kind in ("edit_schedule", "delete_schedule") and not self.schedule_ids:
+            kind = "create_schedule"
+        if kind == "read_schedules":
+            status, text = self.send(kind, "GET", "/schedules/")
+            if status == 200:
+                self.schedule_ids = self.own_rows.findall(text.decode())
+        elif kind == "read_lines":
+            self.send(kind, "GET", "/lines/")
+        elif kind == "read_status":
+            self.send(kind, "GET", "/status")
+        elif kind == "create_schedule":
+            self.send(kind, "POST", "/schedules/create", self.schedule_fields())
+        elif kind == "edit_schedule":
+            schedule_id = self.random.choice(self.schedule_ids)
+            self.send(kind, "POST", f"/schedules/edit/{schedule_id}", self.schedule_fields())
+        elif kind == "delete_schedule":
+            schedule_id = self.schedule_ids.pop(self.random.randrange(len(self.schedule_ids)))
+            self.send(kind, "GET", f"/schedules/delete/{schedule_id}")
+        elif kind == "edit_line":
+            self.send(
+                kind,
+                "POST",
+                f"/lines/edit/{self.line_id}",
+                {
+                    "name": f"Load {self.number}",
+                    "gpio_pin": CLIENT_PIN + self.number,
+                    "flow": self.random.randint(1, 2),
+                    "crop_coefficient": 1,
+                    "node_id": "",
+                },
+            )
+        elif kind == "toggle_maintenance":
+            # On and straight off again, so the schedules mostly keep firing
+            for _ in range(2):
+                self.send(kind, "POST", "/maintenance/toggle_maintenance", {})
+
+
+def run_client(port, number, line_id, day, duration, think):
+    client = Client(port, number, line_id, day)
+    kinds = [kind for kind, weight in MIX for _ in range(weight)]
+    ends = time.perf_counter() + duration
+    while time.perf_counter() < ends:
+        client.step(client.random.choice(kinds))
+        if think:
+            time.sleep(think)
+    client.connection.close()
+    return dict(client.latencies), {kind: dict(counts) for kind, counts in client.outcomes.items()}
+
+
+def scrape(port):
+    """``{(name, labels): value}`` from the server's /metrics."""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request("GET", "/metrics")
+        text = connection.getresponse().read().decode()
+    finally:
+        connection.close()
+    samples = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples[(name, tuple(LABEL.findall(labels or "")))] = float(value)
+    return samples
+
+
+def delta(before, after, name):
+    """``{labels: increase}`` of every series of ``name``."""
+    return {
+        labels: value - before.get((series, labels), 0)
+        for (series, labels), value in after.items()
+        if series == name
+    }
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+
+    def at(q):
+        return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)] * 1000
+
+    return {"p50_ms": at(0.5), "p95_ms": at(0.95), "p99_ms": at(0.99), "max_ms": ordered[-1] * 1000}
+
+
+def bucket_quantile(q, buckets):
+    """Quantile ``q`` of a histogram's ``[(le, cumulative count)]``,
+    interpolated within its bucket like Prometheus does."""
+    total = buckets[-1][1]
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0
+    for le, count in buckets:
+        if count >= rank:
+            if le == math.inf:
+                return lower
+            return lower + (le - lower) * (rank - below) / (count - below)
+        lower, below = le, count
+    return lower
+
+
+def lateness(before, after):
+    """Percentiles of scheduler lateness in milliseconds, by job."""
+    name = "watering_scheduler_lateness_seconds"
+    counts = {dict(labels)["job"]: value for labels, value in delta(before, after, name + "_count").items()}
+    sums = {dict(labels)["job"]: value for labels, value in delta(before, after, name + "_sum").items()}
+    buckets = collections.defaultdict(list)
+    for labels, value in delta(before, after, name + "_bucket").items():
+        labels = dict(labels)
+        buckets[labels["job"]].append((float(labels["le"]), value))
+    jobs = {}
+    for job, count in counts.items():
+        if not count:
+            continue
+        ordered = sorted(buckets[job])
+        jobs[job] = {
+            "fired": int(count),
+            "mean_ms": sums[job] / count * 1000,
+            **{
+                f"p{round(q * 100)}_ms": bucket_quantile(q, ordered) * 1000
+                for q in (0.5, 0.95, 0.99)
+            },
+        }
+    return jobs
+
+
+def run(args):
+    start = datetime.datetime.now().replace(second=0, microsecond=0)
+    day = (start.weekday() + 3) % 7
+    with tempfile.TemporaryDirectory() as tmp:
+        env = server_env(tmp, args.port)
+        line_ids = seed_dense(
+            env["WATERING_DB"],
+            args.lines,
+            args.clients,
+            start,
+            math.ceil(args.duration / 60) + 2,
+        )
+        with serve(env, args.workers, args.threads, args.verbose):
+            before = scrape(args.port)
+            with multiprocessing.Pool(args.clients) as pool:
+                results = pool.starmap(
+                    run_client,
+                    [
+                        (args.port, number, line_ids[number], day, args.duration, args.think)
+                        for number in range(args.clients)
+                    ],
+                )
+            after = scrape(args.port)
+
+    latencies = collections.defaultdict(list)
+    outcomes = collections.defaultdict(collections.Counter)
+    for client_latencies, client_outcomes in results:
+        for kind, samples in client_latencies.items():
+            latencies[kind] += samples
+            latencies["all"] += samples
+        for kind, counts in client_outcomes.items():
+            outcomes[kind].update(counts)
+            outcomes["all"].update(counts)
+
+    requests = {}
+    for kind in [kind for kind, _ in MIX] + ["all"]:
+        counts = outcomes[kind]
+        total = sum(counts.values())
+        requests[kind] = {
+            "requests": total,
+            "error_rate": counts["error"] / total if total else 0,
+            "rejected_rate": counts["rejected"] / total if total else 0,
+            **percentiles(latencies[kind]),
+        }
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "server": "main.py" if args.workers is None else f"gunicorn {args.workers} workers",
+        "clients": args.clients,
+        "lines": args.lines,
+        "duration_s": args.duration,
+        "requests_per_s": requests["all"]["requests"] / args.duration,
+        "requests": requests,
+        "sqlite_busy_retries": sum(
+            delta(before, after, "watering_sqlite_busy_retries_total").values()
+        ),
+        "sqlite_busy_errors": sum(
+            delta(before, after, "watering_sqlite_busy_errors_total").values()
+        ),
+        "scheduler_lateness": lateness(before, after),
+    }
+
+
+def print_report(report):
+    def ms(value):
+        return "-" if value is None else f"{value:.1f}"
+
+    print(
+        f"{report['server']}, {report['clients']} clients, {report['lines']} dense lines, "
+        f"{report['requests_per_s']:.1f} req/s",
+        file=sys.stderr,
+    )
+    print(
+        f"{'request':<20} {'count':>7} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} "
+        f"{'errors':>7} {'rejected':>8}",
+        file=sys.stderr,
+    )
+    for kind, stats in report["requests"].items():
+        print(
+            f"{kind:<20} {stats['requests']:>7} {ms(stats['p50_ms']):>8} "
+            f"{ms(stats['p95_ms']):>8} {ms(stats['p99_ms']):>8} "
+            f"{stats['error_rate']:>7.2%} {stats['rejected_rate']:>8.2%}",
+            file=sys.stderr,
+        )
+    print(
+        f"SQLite busy retries {report['sqlite_busy_retries']:.0f}, "
+        f"gave up {report['sqlite_busy_errors']:.0f}",
+        file=sys.stderr,
+    )
+    if not report["scheduler_lateness"]:
+        print("No scheduler jobs fired, run for longer", file=sys.stderr)
+    for job, stats in report["scheduler_lateness"].items():
+        print(
+            f"lateness {job:<15} fired={stats['fired']:<6} mean={ms(stats['mean_ms'])}ms "
+            f"p50={ms(stats['p50_ms'])}ms p95={ms(stats['p95_ms'])}ms "
+            f"p99={ms(stats['p99_ms'])}ms",
+            file=sys.stderr,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--lines", type=int, default=200, help="lines on dense schedules")
+    parser.add_argument("--duration", type=float, default=150)
+    parser.add_argument("--think", type=float, default=0, help="seconds between requests")
+    parser.add_argument("--workers", type=int, help="serve with gunicorn instead of main.py")
+    parser.add_argument("--threads", type=int, default=8, help="threads per worker")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Before/after latency of opening a connection per block vs the pool.
+
+Replays the query pattern of one ``add_schedule`` request (conflict check,
+insert, schedule reload) against a scratch copy of the database.
+
+Run from the ``web`` directory:
+
+    python -m benchmarks.sqlite_connections [--requests N] [--threads N]
+"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+from createdb import migrate
+from utils import SQLite, dict_factory, close_all_connections
+
+
+class PerBlockSQLite:
+    """The original context manager, one connect/close per block."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        self.conn = sqlite3.connect(self.file)
+        self.conn.row_factory = dict_factory
+        return self.conn
+
+    def __exit__(self, type, value, traceback):
+        if traceback is None:
+            self.conn.commit()
+        self.conn.close()
+
+
+def simulated_request(manager, file):
+    with manager(file) as db:
+        db.execute(
+            "SELECT * FROM watering_schedule WHERE start_minute < ? AND end_minute > ?",
+            (510, 480),
+        ).fetchall()
+    with manager(file) as db:
+        db.execute("SELECT value FROM settings WHERE key = 'maintenance_mode'")
+    with manager(file) as db:
+        db.execute(
+            """
+            SELECT wl.gpio_pin, wl.name, ws.repeat_days, ws.start_minute, ws.end_minute
+            FROM watering_schedule ws
+            INNER JOIN watering_lines wl ON ws.watering_line_id = wl.id
+            """
+        ).fetchall()
+
+
+def measure(manager, file, requests, threads):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count):
+        local = []
+        for _ in range(count):
+            started = time.perf_counter()
+            simulated_request(manager, file)
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    per_thread = max(1, requests // threads)
+    workers = [
+        threading.Thread(target=worker, args=(per_thread,)) for _ in range(threads)
+    ]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "requests_per_s": len(latencies) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default="watering_system.db")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, "bench.db")
+        shutil.copyfile(args.database, file)
+        migrate(file)
+
+        for label, manager in (("per-block", PerBlockSQLite), ("pooled", SQLite)):
+            for threads in sorted({1, args.threads}):
+                result = measure(manager, file, args.requests, threads)
+                print(
+                    f"{label:>9} threads={threads} "
+                    f"mean={result['mean_ms']:.3f}ms "
+                    f"p50={result['p50_ms']:.3f}ms "
+                    f"p95={result['p95_ms']:.3f}ms "
+                    f"{result['requests_per_s']:.0f} req/s"
+                )
+        close_all_connections()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Benchmark the scheduler, conflict checks and web routes.
+
+Each database size runs in its own process against a freshly seeded
+temporary database and the dummy pin controller, so no hardware is touched
+and the real watering_system.db is left alone.
+
+Run from the ``web`` directory:
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --compare results.json
+
+With ``--compare`` the exit status is 1 when any benchmark's median is
+more than ``--threshold`` slower than in the earlier results.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+SIZES = [10, 100, 1000, 10000]
+
+
+def summarize(samples):
+    """Timing statistics in milliseconds for a list of durations in seconds."""
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        "iterations": len(ordered),
+        "mean_ms": total / len(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+        "per_s": len(ordered) / total if total else None,
+    }
+
+
+def timed(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def seed(file, size):
+    """Create ``size`` watering lines and ``size`` non-overlapping schedules.
+
+    Schedules are one minute long and spread over the days of the week, so
+    up to 10080 fit without conflicting. The first line uses a real relay
+    pin so the maintenance route can switch it.
+    """
+    from createdb import migrate
+
+    migrate(file)
+    conn = sqlite3.connect(file)
+    pins = [11] + [1000 + index for index in range(1, size)]
+    conn.executemany(
+        "INSERT INTO watering_lines (name, gpio_pin) VALUES (?, ?)",
+        [(f"Line {index}", pin) for index, pin in enumerate(pins)],
+    )
+    line_ids = [row[0] for row in conn.execute("SELECT id FROM watering_lines")]
+    schedules = []
+    for index in range(size):
+        day, minute = index % 7, index // 7
+        schedules.append((line_ids[index % len(line_ids)], minute, minute + 1, 1 << day))
+    conn.executemany(
+        """
+        INSERT INTO watering_schedule
+            (watering_line_id, start_minute, end_minute, repeat_days)
+        VALUES (?, ?, ?, ?)
+        """,
+        schedules,
+    )
+    conn.commit()
+    conn.close()
+    return line_ids
+
+
+def run_size(size):
+    """Benchmark one database size. Expects WATERING_DB to name a new file."""
+    line_ids = seed(os.environ["WATERING_DB"], size)
+
+    import main
+
+    main.pin_controller.enable_all_lines()
+    main.actuator.start()
+    main.load_occupancy()
+    main.load_schedules()
+
+    iterations = max(3, min(100, 10000 // size))
+    results = {
+        "load_schedules": timed(main.load_schedules, iterations),
+        "reload_schedules": timed(main.reload_schedules, iterations),
+        "load_occupancy": timed(main.load_occupancy, iterations),
+    }
+
+    # Monday 00:00-00:01 is always taken by the first seeded schedule
+    def conflicting_add():
+        try:
+            main.add_schedule(line_ids[0], 0, 1, 1)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected a schedule conflict")
+
+    # Which schedules should be watering now, as done on startup and reload
+    from reconcile import ScheduleWindows
+    from utils import SQLite
+
+    with SQLite() as db:
+        schedules = db.execute(main.SCHEDULE_JOBS_QUERY).fetchall()
+    windows = ScheduleWindows(schedules)
+    results["reconcile_build_windows"] = timed(
+        lambda: ScheduleWindows(schedules), iterations
+    )
+    results["reconcile_active_now"] = timed(lambda: windows.active(1440 * 3 + 30), 1000)
+
+    # Today's run length of every schedule from a weather feed, once a day
+    from weather import WeatherAdjuster
+
+    today = datetime.date.today()
+    feed = os.path.join(os.path.dirname(os.environ["WATERING_DB"]), "weather.csv")
+    with open(feed, "w") as file:
+        file.write(f"date,et0,rain\n{today},6.5,1.5\n")
+    adjuster = WeatherAdjuster(feed)
+    adjuster.set_schedules(schedules)
+
+    def adjust_all():
+        adjuster.set_reference_et(5.0)  # Forces a recompute
+        adjuster.minutes(schedules[0]["id"], today, 0)
+
+    results["weather_adjust_all"] = timed(adjust_all, iterations)
+
+    results["add_schedule_conflict"] = timed(conflicting_add, 1000)
+    results["occupancy_conflicts_all_days"] = timed(
+        lambda: main.occupancy.conflicts(line_ids[0], 1430, 1439, range(7)), 1000
+    )
+
+    client = main.app.test_client()
+    for route in ("/schedules/", "/lines/", "/maintenance"):
+        results[f"GET {route}"] = timed(lambda: client.get(route), iterations)
+    maintenance_line = {"line_id": str(line_ids[0]), "action": "on"}
+    results["POST /maintenance"] = timed(
+        lambda: client.post("/maintenance", data=maintenance_line), iterations
+    )
+
+    main.actuator.stop()
+    return [
+        {"size": size, "benchmark": name, **stats} for name, stats in results.items()
+    ]
+
+
+def run_worker(size):
+    json.dump(run_size(size), sys.stdout)
+
+
+def run_all(sizes, verbose):
+    results = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                WATERING_DB=os.path.join(tmp, "bench.db"),
+                WATERING_PIN_CONTROLLER="dummy",
+            )
+            completed = subprocess.run(
+                [sys.executable, "-m", "benchmarks.suite", "--worker", str(size)],
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=None if verbose else subprocess.DEVNULL,
+                check=True,
+                text=True,
+            )
+        for result in json.loads(completed.stdout):
+            results.append(result)
+            print(
+                f"{result['size']:>6} {result['benchmark']:<30} "
+                f"p50={result['p50_ms']:9.3f}ms p95={result['p95_ms']:9.3f}ms",
+                file=sys.stderr,
+            )
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Benchmarks whose median got slower than the baseline by ``threshold``."""
+    previous = {
+        (result["size"], result["benchmark"]): result
+        for result in baseline["results"]
+    }
+    regressions = []
+    for result in results:
+        before = previous.get((result["size"], result["benchmark"]))
+        if before and result["p50_ms"] > before["p50_ms"] * (1 + threshold):
+            regressions.append(
+                {
+                    "size": result["size"],
+                    "benchmark": result["benchmark"],
+                    "before_p50_ms": before["p50_ms"],
+                    "after_p50_ms": result["p50_ms"],
+                }
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--compare", help="earlier JSON results to check against")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker)
+        return
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "node": platform.node(),
+        "results": run_all(args.sizes, args.verbose),
+    }
+    if args.compare:
+        with open(args.compare) as baseline:
+            report["regressions"] = compare(
+                report["results"], json.load(baseline), args.threshold
+            )
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    if report.get("regressions"):
+        for regression in report["regressions"]:
+            print(
+                f"REGRESSION {regression['size']} {regression['benchmark']}: "
+                f"{regression['before_p50_ms']:.3f}ms -> "
+                f"{regression['after_p50_ms']:.3f}ms",
+                file=sys.stderr,
+            )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
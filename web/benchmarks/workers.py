@@ -0,0 +1,193 @@
+"""Requests per second served by the dev server and by 1..N web workers.
+
+For each setup a freshly seeded temporary database is served with the
+dummy pin controller: first ``main.py`` on its own, then ``controller.py``
+with gunicorn running each of the ``--workers`` counts. ``--clients``
+client processes then send a mix of page, status and settings requests
+over kept-alive connections for ``--duration`` seconds.
+
+Run from the ``web`` directory, with gunicorn installed:
+
+    python -m benchmarks.workers --workers 1 2 4 --clients 16 --duration 10
+"""
+
+import argparse
+import contextlib
+import http.client
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from benchmarks.suite import seed, summarize
+
+PORT = 5400
+
+# (method, path, weight). Capacity writes go to the controller and drop
+# the cached pages, so list pages are rendered again now and then.
+MIX = [
+    ("GET", "/status", 4),
+    ("GET", "/", 2),
+    ("GET", "/schedules/", 2),
+    ("GET", "/lines/", 2),
+    ("GET", "/history", 1),
+    ("POST", "/lines/capacity", 1),
+]
+
+
+def client(port, duration, number):
+    """Send requests until ``duration`` is up, returns the latencies and
+    how many failed."""
+    requests = [(method, path) for method, path, weight in MIX for _ in range(weight)]
+    # Clients start at different points of the mix
+    index = number
+    latencies = []
+    errors = 0
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    ends = time.perf_counter() + duration
+    while time.perf_counter() < ends:
+        method, path = requests[index % len(requests)]
+        index += 1
+        body, headers = None, {}
+        if method == "POST":
+            body = urllib.parse.urlencode({"supply_capacity": 1 + index % 3})
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            # Kept-alive connection closed by the server
+            connection.close()
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+        if response.status >= 400:
+            errors += 1
+    connection.close()
+    return latencies, errors
+
+
+def wait_until_serving(port, process, timeout=30):
+    ends = time.monotonic() + timeout
+    while time.monotonic() < ends:
+        if process.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/status")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        finally:
+            connection.close()
+        time.sleep(0.2)
+    raise RuntimeError(f"nothing serving on port {port} after {timeout}s")
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def server_env(tmp, port):
+    """Environment to serve a database in ``tmp`` with the dummy pins."""
+    return dict(
+        os.environ,
+        WATERING_DB=os.path.join(tmp, "bench.db"),
+        WATERING_PIN_CONTROLLER="dummy",
+        WATERING_CONTROL_SOCKET=os.path.join(tmp, "control.sock"),
+        WATERING_PORT=str(port),
+        WATERING_LOG_LEVEL="WARNING",
+    )
+
+
+@contextlib.contextmanager
+def serve(env, workers=None, threads=8, verbose=False):
+    """Run main.py, or with ``workers`` controller.py and gunicorn, until
+    the block ends."""
+    output = None if verbose else subprocess.DEVNULL
+    if workers is None:
+        commands = [[sys.executable, "main.py"]]
+    else:
+        commands = [
+            [sys.executable, "controller.py"],
+            [
+                sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+                "--workers", str(workers), "--threads", str(threads), "wsgi:app",
+            ],
+        ]
+    processes = []
+    try:
+        for command in commands:
+            processes.append(subprocess.Popen(command, env=env, stdout=output, stderr=output))
+        wait_until_serving(int(env["WATERING_PORT"]), processes[-1])
+        yield
+    finally:
+        for process in reversed(processes):
+            stop(process)
+
+
+def measure(label, workers, args, verbose):
+    """Serve a new database the way ``workers`` says, None for main.py, and
+    load it with the client processes."""
+    with tempfile.TemporaryDirectory() as tmp:
+        env = server_env(tmp, args.port)
+        seed(env["WATERING_DB"], args.size)
+        with serve(env, workers, args.threads, verbose):
+            with multiprocessing.Pool(args.clients) as pool:
+                results = pool.starmap(
+                    client, [(args.port, args.duration, number) for number in range(args.clients)]
+                )
+    latencies = [latency for result in results for latency in result[0]]
+    stats = summarize(latencies)
+    return {
+        "server": label,
+        "workers": workers or 1,
+        "requests": len(latencies),
+        "errors": sum(result[1] for result in results),
+        "requests_per_s": len(latencies) / args.duration,
+        "p50_ms": stats["p50_ms"],
+        "p95_ms": stats["p95_ms"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=8, help="threads per worker")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--size", type=int, default=100, help="lines and schedules")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    results = []
+    for label, workers in [("main.py", None)] + [("gunicorn", n) for n in args.workers]:
+        result = measure(label, workers, args, args.verbose)
+        results.append(result)
+        print(
+            f"{result['server']:<9} {result['workers']:>2} workers "
+            f"{result['requests_per_s']:8.1f} req/s  p50={result['p50_ms']:7.2f}ms "
+            f"p95={result['p95_ms']:7.2f}ms  errors={result['errors']}",
+            file=sys.stderr,
+        )
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Parsing and formatting for bulk import and export of lines and schedules.
+
+Both accept and produce JSON (a list of objects) or CSV with a header row.
+Schedules use the same "HH:MM" times and "Mon,Wed" day lists as the forms.
+"""
+
+import csv
+import io
+import json
+
+from utils import DAYS, days_to_mask, mask_to_days, minute_to_time, time_to_minute
+
+LINE_FIELDS = ["id", "name", "gpio_pin", "flow", "crop_coefficient", "node_id"]
+SCHEDULE_FIELDS = ["id", "watering_line_id", "line", "start_time", "end_time", "repeat_days"]
+
+# Rows fetched at a time while exporting
+EXPORT_CHUNK = 500
+
+# Highest crop coefficient accepted, well above any real plant's
+MAX_CROP_COEFFICIENT = 3.0
+
+
+class BatchError(ValueError):
+    """A batch that can't be imported. ``errors`` lists ``(row, message)``
+    for every bad row, rows numbered from 1."""
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} invalid rows")
+        self.errors = errors
+
+
+def read_rows(request):
+    """The rows of an import request, from a JSON list or CSV body."""
+    if request.mimetype == "text/csv":
+        return list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    rows = request.get_json(silent=True)
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise BatchError([(0, "Expected a JSON list of objects or a text/csv body")])
+    return rows
+
+
+def _integer(value, field):
+    # JSON gives ints, CSV gives text; true and 2.5 aren't pins or ids
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{field} must be an integer")
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{field} must be an integer")
+
+
+def _positive_int(value, field):
+    number = _integer(value, field)
+    if number <= 0:
+        raise ValueError(f"{field} must be positive")
+    return number
+
+
+def _minute(value, field):
+    if not isinstance(value, str):
+        raise ValueError(f"{field} must be a time like 06:30")
+    try:
+        hours, minutes = value.split(":")
+        if not (0 <= int(hours) < 24 and 0 <= int(minutes) < 60):
+            raise ValueError
+    except ValueError:
+        raise ValueError(f"{field} must be a time like 06:30")
+    return time_to_minute(value)
+
+
+def _days_mask(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        # Already a repeat_days bitmask
+        if not 0 < value < 1 << len(DAYS):
+            raise ValueError("repeat_days mask must be between 1 and 127")
+        return value
+    if isinstance(value, str):
+        value = [day.strip() for day in value.split(",") if day.strip()]
+    if not isinstance(value, list) or not all(isinstance(day, str) for day in value):
+        raise ValueError("repeat_days must be a list of day names or a bitmask")
+    unknown = [day for day in value if day not in DAYS]
+    if unknown or not value:
+        raise ValueError(f"repeat_days must be day names from {','.join(DAYS)}")
+    return days_to_mask(value)
+
+
+def _coefficient(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError("crop_coefficient must be a number")
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError("crop_coefficient must be a number")
+    if not 0 < number <= MAX_CROP_COEFFICIENT:
+        raise ValueError(f"crop_coefficient must be above 0 and at most {MAX_CROP_COEFFICIENT}")
+    return number
+
+
+def _optional(row, field, default):
+    # Left out of a JSON object or empty in a CSV column, but not 0
+    value = row.get(field)
+    return default if value is None or value == "" else value
+
+
+def parse_lines(rows, used_pins, node_ids):
+    """``(name, gpio_pin, flow, crop_coefficient, node_id)`` for each row.
+    ``used_pins`` are the ``(node_id, gpio_pin)`` pairs already taken by
+    existing lines, ``node_ids`` the controller nodes lines may be bound to.
+    A missing node_id is this controller, None."""
+    lines = []
+    errors = []
+    pins = set(used_pins)
+    for number, row in enumerate(rows, start=1):
+        try:
+            name = _optional(row, "name", "")
+            if not isinstance(name, str):
+                raise ValueError("name must be text")
+            name = name.strip()
+            if not name:
+                raise ValueError("name is required")
+            gpio_pin = _integer(row.get("gpio_pin"), "gpio_pin")
+            node_id = _optional(row, "node_id", None)
+            if node_id is not None:
+                node_id = _integer(node_id, "node_id")
+                if node_id not in node_ids:
+                    raise ValueError(f"no controller node with id {node_id}")
+            # Pins are per controller
+            if (node_id, gpio_pin) in pins:
+                raise ValueError(f"GPIO pin {gpio_pin} is already in use")
+            flow = _positive_int(_optional(row, "flow", 1), "flow")
+            coefficient = _coefficient(_optional(row, "crop_coefficient", 1))
+        except ValueError as e:
+            errors.append((number, str(e)))
+            continue
+        pins.add((node_id, gpio_pin))
+        lines.append((name, gpio_pin, flow, coefficient, node_id))
+    if errors:
+        raise BatchError(errors)
+    return lines
+
+
+def parse_schedules(rows, line_ids_by_name):
+    """``(watering_line_id, start_minute, end_minute, repeat_days)`` for each
+    row. Rows name their line by ``watering_line_id`` or by ``line``."""
+    schedules = []
+    errors = []
+    line_ids = set(line_ids_by_name.values())
+    for number, row in enumerate(rows, start=1):
+        try:
+            if row.get("watering_line_id") not in (None, ""):
+                line_id = _positive_int(row["watering_line_id"], "watering_line_id")
+                if line_id not in line_ids:
+                    raise ValueError(f"no watering line with id {line_id}")
+            elif isinstance(row.get("line"), str) and row["line"] in line_ids_by_name:
+                line_id = line_ids_by_name[row["line"]]
+            else:
+                raise ValueError(f"no watering line named {row.get('line')!r}")
+            schedules.append(
+                (
+                    line_id,
+                    _minute(row.get("start_time"), "start_time"),
+                    _minute(row.get("end_time"), "end_time"),
+                    _days_mask(_optional(row, "repeat_days", "")),
+                )
+            )
+        except ValueError as e:
+            errors.append((number, str(e)))
+    if errors:
+        raise BatchError(errors)
+    return schedules
+
+
+def line_record(row):
+    return {field: row[field] for field in LINE_FIELDS}
+
+
+def schedule_record(row):
+    return {
+        "id": row["id"],
+        "watering_line_id": row["watering_line_id"],
+        "line": row["line"],
+        "start_time": minute_to_time(row["start_minute"]),
+        "end_time": minute_to_time(row["end_minute"]),
+        "repeat_days": ",".join(DAYS[day] for day in mask_to_days(row["repeat_days"])),
+    }
+
+
+def stream_records(chunks, record, fields, format):
+    """Yield the rows of each list in ``chunks`` as JSON or CSV text, so an
+    export never holds the whole table in memory."""
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fields)
+        writer.writeheader()
+        for rows in chunks:
+            writer.writerows(record(row) for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+        return
+
+    first = True
+    yield "["
+    for rows in chunks:
+        chunk = ",\n".join(json.dumps(record(row)) for row in rows)
+        yield ("\n" if first else ",\n") + chunk
+        first = False
+    yield "]\n" if first else "\n]\n"
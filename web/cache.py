@@ -0,0 +1,72 @@
+import collections
+import threading
+import uuid
+
+import metrics
+
+CACHE_LOOKUPS = metrics.counter(
+    "watering_page_cache_lookups_total", "Page cache lookups, by result.", ("result",)
+)
+
+
+class PageCache:
+    """Rendered pages kept until the data behind them changes.
+
+    Every write bumps ``version`` with ``invalidate()``, which makes every
+    entry stale at once without walking them. Entries are looked up by key,
+    usually the request path, and the least recently used are evicted past
+    ``max_entries``.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.version = 0
+        # ETags must not repeat after a restart resets the version
+        self._instance = uuid.uuid4().hex[:8]
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def current(self):
+        """``(instance, version)``, for ``follow()`` in another process."""
+        with self._lock:
+            return self._instance, self.version
+
+    def follow(self, instance, version):
+        """Take on the version of the cache in another process, e.g. the
+        controller's, so every web worker drops pages and gives out ETags
+        in step with it."""
+        with self._lock:
+            if instance != self._instance:
+                # A restarted controller counts from 0 again
+                self._entries.clear()
+            self._instance = instance
+            self.version = version
+
+    def get(self, key):
+        """``(etag, body)`` if ``key`` is cached for the current version."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != self.version:
+                CACHE_LOOKUPS.inc(result="miss")
+                return None
+            self._entries.move_to_end(key)
+        CACHE_LOOKUPS.inc(result="hit")
+        return entry[1], entry[2]
+
+    def put(self, key, body, version):
+        """Cache ``body``, rendered from the data as of ``version``, and
+        return its ``(etag, body)``."""
+        etag = f"{self._instance}-{version}"
+        with self._lock:
+            # Rendered before a write that has since landed, don't keep it
+            if version == self.version:
+                self._entries[key] = (version, etag, body)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return etag, body
@@ -0,0 +1,197 @@
+"""Commands from the web workers to the controller process.
+
+When served by a multi-worker WSGI server (see wsgi.py), one controller
+process (controller.py) owns the scheduler, the relays and every in-memory
+index. The workers read the database themselves and send everything else
+to the controller over a Unix socket, one JSON object per line each way:
+
+    {"command": "add_schedule", "args": [...], "kwargs": {...}}
+    {"result": ...}   or   {"error": "...", "type": "ValueError"}
+
+A command that returns a generator, like the live event stream, answers
+with ``{"item": ...}`` lines and a final ``{"end": true}``, and its
+connection is closed after it.
+"""
+
+import inspect
+import json
+import logging
+import os
+import select
+import socket
+import socketserver
+import threading
+
+import metrics
+from bulk import BatchError
+
+logger = logging.getLogger(__name__)
+
+SOCKET = os.environ.get("WATERING_CONTROL_SOCKET", "/tmp/watering_control.sock")
+
+# Errors that carry a message for the user, raised again in the worker
+ERRORS = {"ValueError": ValueError, "KeyError": KeyError}
+
+CONTROL_CALLS = metrics.histogram(
+    "watering_control_call_seconds",
+    "Time for the controller to answer a web worker's command, by command.",
+    ("command",),
+)
+
+
+class ControlError(Exception):
+    pass
+
+
+def _encode(message):
+    # Datetimes and the like go over as text
+    return (json.dumps(message, default=str) + "\n").encode()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                func = self.server.commands[request["command"]]
+            except (ValueError, KeyError, TypeError):
+                self.wfile.write(_encode({"error": "Unknown command", "type": "ControlError"}))
+                return
+            try:
+                result = func(*request.get("args", ()), **request.get("kwargs", {}))
+            except BatchError as e:
+                answer = {"error": str(e), "type": "BatchError", "errors": e.errors}
+            except (ValueError, KeyError) as e:
+                answer = {"error": str(e), "type": type(e).__name__}
+            except Exception as e:
+                logger.exception(f"Control command {request['command']} failed")
+                answer = {"error": str(e), "type": "ControlError"}
+            else:
+                if inspect.isgenerator(result):
+                    self._stream(result)
+                    return
+                answer = {"result": result}
+            self.wfile.write(_encode(answer))
+
+    def _stream(self, items):
+        # Ends when the generator does or when the worker hangs up, which
+        # shows up as a failed write
+        try:
+            for item in items:
+                self.wfile.write(_encode({"item": item}))
+            self.wfile.write(_encode({"end": True}))
+        except OSError:
+            pass
+        finally:
+            items.close()
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Runs ``commands[name](*args, **kwargs)`` for each request, a thread
+    per connection."""
+
+    daemon_threads = True
+
+    def __init__(self, path, commands):
+        self.commands = commands
+        # Left behind by a controller that didn't shut down cleanly
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, _Handler)
+        # Only the owner and its group, which the web workers should run as
+        os.chmod(path, 0o660)
+
+
+class ControlClient:
+    """Sends commands to the controller, over a connection per thread that
+    is kept open between them."""
+
+    TIMEOUT = 30
+
+    def __init__(self, path=SOCKET):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            raise ControlError(f"Controller unreachable at {self.path}: {e}")
+        return sock, sock.makefile("rb")
+
+    def _close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection[0].close()
+            self._local.connection = None
+
+    def _kept(self):
+        """The thread's open connection, None if there is none or the
+        controller has closed it since."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            return None
+        # The controller only writes answers, so a kept connection with
+        # something to read has been closed, e.g. by a restart
+        if select.select([connection[0]], [], [], 0)[0]:
+            self._close()
+            return None
+        return connection
+
+    def call(self, command, *args, **kwargs):
+        data = _encode({"command": command, "args": args, "kwargs": kwargs})
+        with CONTROL_CALLS.time(command=command):
+            for attempt in (1, 2):
+                reused = self._kept() is not None
+                if not reused:
+                    self._local.connection = self._connect(self.TIMEOUT)
+                try:
+                    self._local.connection[0].sendall(data)
+                    break
+                except OSError:
+                    self._close()
+                    # Nothing reached the controller, so the command didn't
+                    # run, try once on a new connection
+                    if not reused or attempt == 2:
+                        raise ControlError(f"Controller closed the connection during {command}")
+            # Once sent the command may have run, so it is never sent twice
+            reader = self._local.connection[1]
+            try:
+                line = reader.readline()
+            except TimeoutError:
+                self._close()
+                raise ControlError(f"Controller didn't answer {command} in time")
+            except OSError:
+                line = b""
+            if not line:
+                self._close()
+                raise ControlError(f"Controller closed the connection during {command}")
+        return _result(json.loads(line))
+
+    def stream(self, command, *args, timeout=None, **kwargs):
+        """The items of a command that returns a generator, on a connection
+        of their own. Closing the generator hangs up."""
+        sock, reader = self._connect(timeout)
+        try:
+            sock.sendall(_encode({"command": command, "args": args, "kwargs": kwargs}))
+            for line in reader:
+                answer = json.loads(line)
+                if "item" in answer:
+                    yield answer["item"]
+                elif answer.get("end"):
+                    return
+                else:
+                    _result(answer)
+        finally:
+            sock.close()
+
+
+def _result(answer):
+    if "error" not in answer:
+        return answer.get("result")
+    if answer["type"] == "BatchError":
+        raise BatchError([tuple(error) for error in answer["errors"]])
+    raise ERRORS.get(answer["type"], ControlError)(answer["error"])
@@ -0,0 +1,28 @@
+"""The controller process of a multi-worker deployment, see wsgi.py.
+
+Owns the scheduler, the relays and every in-memory index, like main.py
+does on its own, and runs the commands the web workers send it over the
+control socket instead of serving HTTP.
+
+Run from the ``web`` directory, before the web workers:
+
+    python controller.py
+"""
+
+import logging
+
+import main
+from control import SOCKET, ControlServer
+
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    main.exit_on_sigterm()
+    main.start()
+    server = ControlServer(SOCKET, main.commands)
+    logger.info(f"Taking commands from web workers on {SOCKET}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        main.stop()
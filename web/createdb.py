@@ -1,12 +1,12 @@
+import logging
 import sqlite3
 
-# Path to your SQLite database file
-DATABASE = "watering_system.db"
+from utils import DATABASE, days_to_mask, time_to_minute
 
+logger = logging.getLogger(__name__)
 
-def create_db():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+
+def create_tables(cursor):
     # Create the watering_lines table
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS watering_lines (
@@ -40,6 +40,198 @@ def create_db():
     """)
 
 
+def integer_schedule_times(cursor):
+    # SQLite can't change a column's type, so rebuild the table and convert
+    # each row from "HH:MM" text and "Mon,Wed" strings
+    cursor.execute("""
+    CREATE TABLE watering_schedule_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        watering_line_id INTEGER NOT NULL,
+        start_minute INTEGER NOT NULL,
+        end_minute INTEGER NOT NULL,
+        repeat_days INTEGER NOT NULL,
+        FOREIGN KEY (watering_line_id) REFERENCES watering_lines (id) ON DELETE CASCADE
+    )
+    """)
+    rows = cursor.execute("""
+    SELECT id, watering_line_id, start_time, end_time, repeat_days
+    FROM watering_schedule
+    """).fetchall()
+    cursor.executemany(
+        """
+    INSERT INTO watering_schedule_new
+        (id, watering_line_id, start_minute, end_minute, repeat_days)
+    VALUES (?, ?, ?, ?, ?)
+    """,
+        [
+            (
+                schedule_id,
+                watering_line_id,
+                time_to_minute(start_time),
+                time_to_minute(end_time),
+                days_to_mask(repeat_days.split(",")),
+            )
+            for schedule_id, watering_line_id, start_time, end_time, repeat_days in rows
+        ],
+    )
+
+    # Keep handing out new ids after the highest one ever used
+    sequence = cursor.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'watering_schedule'"
+    ).fetchone()
+    cursor.execute("DROP TABLE watering_schedule")
+    cursor.execute("ALTER TABLE watering_schedule_new RENAME TO watering_schedule")
+    if sequence:
+        cursor.execute(
+            "UPDATE sqlite_sequence SET seq = ? WHERE name = 'watering_schedule'",
+            sequence,
+        )
+
+    cursor.execute("""
+    CREATE INDEX idx_watering_schedule_line_start
+    ON watering_schedule (watering_line_id, start_minute)
+    """)
+    cursor.execute("""
+    CREATE INDEX idx_watering_schedule_start_end
+    ON watering_schedule (start_minute, end_minute)
+    """)
+
+
+def pin_polarity_setting(cursor):
+    # Relay boards differ, the 8 relay board is active low
+    cursor.execute("""
+    INSERT OR IGNORE INTO settings (key, value)
+    VALUES ('watering_when_GPIO_high', 'off')
+    """)
+
+
+def line_flow(cursor):
+    # How much of the water supply a line draws while open, in the same
+    # units as the supply_capacity setting. 1 and a capacity of 1 keep the
+    # old behaviour of one line at a time.
+    cursor.execute("""
+    ALTER TABLE watering_lines ADD COLUMN flow INTEGER NOT NULL DEFAULT 1
+    """)
+    cursor.execute("""
+    INSERT OR IGNORE INTO settings (key, value)
+    VALUES ('supply_capacity', '1')
+    """)
+
+
+def watering_history(cursor):
+    # Append only log of what actually happened, lines may since be deleted
+    # so there's no foreign key
+    cursor.execute("""
+    CREATE TABLE watering_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        watering_line_id INTEGER NOT NULL,
+        gpio_pin INTEGER NOT NULL,
+        event TEXT NOT NULL,
+        at TEXT NOT NULL,
+        minutes REAL
+    )
+    """)
+    # Per line and day totals, kept up to date as events are written
+    cursor.execute("""
+    CREATE TABLE watering_daily (
+        day TEXT NOT NULL,
+        watering_line_id INTEGER NOT NULL,
+        runs INTEGER NOT NULL DEFAULT 0,
+        minutes REAL NOT NULL DEFAULT 0,
+        skipped INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, watering_line_id)
+    )
+    """)
+
+
+def moisture_readings(cursor):
+    # Soil moisture averaged per line over fixed periods, see moisture.py
+    cursor.execute("""
+    CREATE TABLE moisture_readings (
+        watering_line_id INTEGER NOT NULL,
+        bucket TEXT NOT NULL,
+        samples INTEGER NOT NULL,
+        total REAL NOT NULL,
+        low REAL NOT NULL,
+        high REAL NOT NULL,
+        PRIMARY KEY (watering_line_id, bucket)
+    )
+    """)
+    cursor.executemany(
+        "INSERT OR IGNORE INTO settings (key, value) VALUES (?, '0')",
+        [("moisture_shorten",), ("moisture_skip",)],
+    )
+
+
+def crop_coefficient(cursor):
+    # How thirsty a line's plants and soil are relative to the reference
+    # crop of the weather feed's ET, see weather.py
+    cursor.execute("""
+    ALTER TABLE watering_lines ADD COLUMN crop_coefficient REAL NOT NULL DEFAULT 1.0
+    """)
+    cursor.execute("""
+    INSERT OR IGNORE INTO settings (key, value)
+    VALUES ('reference_et', '5.0')
+    """)
+
+
+def controller_nodes(cursor):
+    # Other controllers whose relay boards drive some of the lines, see
+    # federation.py
+    cursor.execute("""
+    CREATE TABLE controller_nodes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        url TEXT NOT NULL
+    )
+    """)
+
+    # GPIO pins are only unique per controller now, which takes a rebuild
+    # to drop the UNIQUE on gpio_pin
+    cursor.execute("""
+    CREATE TABLE watering_lines_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        gpio_pin INTEGER NOT NULL,
+        flow INTEGER NOT NULL DEFAULT 1,
+        crop_coefficient REAL NOT NULL DEFAULT 1.0,
+        node_id INTEGER REFERENCES controller_nodes (id)
+    )
+    """)
+    cursor.execute("""
+    INSERT INTO watering_lines_new (id, name, gpio_pin, flow, crop_coefficient)
+    SELECT id, name, gpio_pin, flow, crop_coefficient FROM watering_lines
+    """)
+    sequence = cursor.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'watering_lines'"
+    ).fetchone()
+    cursor.execute("DROP TABLE watering_lines")
+    cursor.execute("ALTER TABLE watering_lines_new RENAME TO watering_lines")
+    if sequence:
+        cursor.execute(
+            "UPDATE sqlite_sequence SET seq = ? WHERE name = 'watering_lines'",
+            sequence,
+        )
+    cursor.execute("""
+    CREATE UNIQUE INDEX idx_watering_lines_node_pin
+    ON watering_lines (IFNULL(node_id, 0), gpio_pin)
+    """)
+
+
+# Applied in order, each exactly once. The number of migrations already run
+# is kept in the database's user_version. Only ever append to this list.
+MIGRATIONS = [
+    create_tables,
+    integer_schedule_times,
+    pin_polarity_setting,
+    line_flow,
+    watering_history,
+    moisture_readings,
+    crop_coefficient,
+    controller_nodes,
+]
+
+
 #   id:
 #       A unique identifier for each schedule.
 
@@ -47,24 +239,69 @@ def create_db():
 #       A foreign key referencing the id of the watering_lines table.
 #       Ensures each schedule is associated with an existing watering line.
 
-#   start_time and end_time:
-#       Store the watering period in a 24-hour format
-#       (e.g., "14:30" for 2:30 PM). Text format is sufficient since
-#       comparisons between times as strings (in "HH:MM" format) are
-#       lexicographically correct.
+#   start_minute and end_minute:
+#       Store the watering period as minutes after midnight (e.g., 870 for
+#       2:30 PM), so comparisons and the indexes work on plain integers.
+#       An end_minute at or before start_minute finishes the next day.
 
 #   repeat_days:
-#       Stores days of the week the schedule repeats, as a comma-separated
-#       string (e.g., "Mon,Wed,Fri").
+#       Stores days of the week the schedule repeats, as a bitmask with
+#       Monday in bit 0 through Sunday in bit 6 (e.g., 21 for Mon,Wed,Fri).
 
 #   FOREIGN KEY Constraint:
 #       Ensures that the watering_line_id corresponds to a valid record in the
 #       watering_lines table. Includes ON DELETE CASCADE to automatically
 #       remove schedules if the corresponding watering line is deleted.
 
-    conn.commit()
-    conn.close()
+#   watering_events:
+#       One row per run started ("start"), finished ("stop", with the
+#       minutes it watered) or skipped for maintenance or wet soil
+#       ("skipped"). ``at``
+#       is the local time as ISO 8601 text.
+
+#   watering_daily:
+#       Rollup of watering_events per line and day: runs started, minutes
+#       watered and runs skipped. A run's minutes count towards the day it
+#       started.
+
+#   watering_lines.node_id:
+#       The controller_nodes row of the controller driving the line, NULL
+#       for lines on this controller's own relay board. A GPIO pin is
+#       unique per controller.
+
+#   moisture_readings:
+#       Soil moisture readings of a line summed per 15 minute bucket, named
+#       by its start time. The average is total / samples, low and high are
+#       the extremes seen in the bucket.
+
+
+def migrate(file=DATABASE):
+    """Bring the database up to date, creating it if needed."""
+    # Autocommit mode, so each migration runs in the explicit transaction
+    conn = sqlite3.connect(file, isolation_level=None)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            try:
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {number}")
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            logger.info(f"Applied database migration {number}: {migration.__name__}")
+    finally:
+        conn.close()
+
+
+def create_db():
+    migrate(DATABASE)
 
 
-# Call the function to create the database and table
-create_db()
+if __name__ == "__main__":
+    # Show the migrations applied
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # Create the database or upgrade an existing one
+    create_db()
@@ -0,0 +1,115 @@
+import collections
+import itertools
+import json
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PUBLISHED = metrics.counter(
+    "watering_events_published_total", "Events published to live clients.", ("event",)
+)
+SLOW_CLIENTS = metrics.counter(
+    "watering_event_clients_dropped_total",
+    "Live clients disconnected because their buffer filled up.",
+)
+
+
+class Subscription:
+    """A client's bounded buffer of events waiting to be sent."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.closed = False
+        self.overflowed = False
+        self._events = collections.deque()
+        self._cond = threading.Condition()
+
+    def put(self, event):
+        """Queue ``event`` without blocking. Returns False if the
+        subscription is closed, which a full buffer also does."""
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._events) >= self.maxsize:
+                self.closed = self.overflowed = True
+                self._cond.notify()
+                return False
+            self._events.append(event)
+            self._cond.notify()
+            return True
+
+    def get(self, timeout):
+        """Next event, or None once ``timeout`` seconds pass without one or
+        the subscription is closed."""
+        with self._cond:
+            if not self._events and not self.closed:
+                self._cond.wait(timeout)
+            if self._events and not self.closed:
+                return self._events.popleft()
+            return None
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+
+class EventBus:
+    """Fans events out to live clients, such as ``/events`` streams.
+
+    Publishing never waits on a client. Each one has a buffer of
+    ``BUFFER_SIZE`` events, a client that falls that far behind is
+    disconnected and picks up the current state again when its browser
+    reconnects.
+    """
+
+    BUFFER_SIZE = 64
+    MAX_CLIENTS = 100
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self):
+        """A new Subscription, or None if there are already MAX_CLIENTS."""
+        with self._lock:
+            if len(self._subscriptions) >= self.MAX_CLIENTS:
+                return None
+            subscription = Subscription(self.BUFFER_SIZE)
+            self._subscriptions.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, event, data):
+        """Send ``data`` as a JSON event named ``event`` to every client."""
+        message = format_event(event, data, next(self._ids))
+        EVENTS_PUBLISHED.inc(event=event)
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if not subscription.put(message):
+                if subscription.overflowed:
+                    SLOW_CLIENTS.inc()
+                    logger.info("Dropped a live client that stopped reading")
+                self.unsubscribe(subscription)
+
+
+def format_event(event, data, event_id=None):
+    """One Server-Sent Events message."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,386 @@
+"""Watering lines on other controllers.
+
+A coordinator binds some of its watering lines to controller nodes, each
+another install of this app driving its own relay board. The lines and
+schedules of a node are pushed to it as batched deltas over HTTP/JSON. The
+node stores them in its own database and fires them itself, so it keeps
+watering while the coordinator is down. The coordinator polls each node's
+state in between.
+
+    POST /api/node/sync   {"full": bool, "lines": [...], "schedules": [...],
+                           "deleted_lines": [id, ...], "deleted_schedules": [...]}
+    GET  /api/node/state
+
+A "full" sync replaces everything on the node, it's sent first after the
+coordinator starts and whenever the node missed earlier deltas. If
+WATERING_NODE_TOKEN is set, requests must carry it in X-Watering-Token,
+otherwise only requests from the node's own host are accepted.
+"""
+
+import hmac
+import http.client
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+import metrics
+from utils import DATABASE, SQLite
+
+logger = logging.getLogger(__name__)
+
+TOKEN = os.environ.get("WATERING_NODE_TOKEN")
+TOKEN_HEADER = "X-Watering-Token"
+
+LINE_FIELDS = ["id", "name", "gpio_pin", "flow", "crop_coefficient"]
+SCHEDULE_FIELDS = ["id", "watering_line_id", "start_minute", "end_minute", "repeat_days"]
+
+NODE_REQUESTS = metrics.counter(
+    "watering_node_requests_total", "Requests to controller nodes, by result.", ("node", "result")
+)
+NODE_SYNC = metrics.histogram(
+    "watering_node_sync_seconds", "Time to push one batch of changes to a node.", ("node",)
+)
+
+
+class NodeError(Exception):
+    pass
+
+
+def authorized(request):
+    """True if a node request may be served. Without a token only local
+    requests are, e.g. copies run side by side for testing."""
+    if TOKEN is None:
+        return request.remote_addr in ("127.0.0.1", "::1")
+    supplied = request.headers.get(TOKEN_HEADER, "")
+    return hmac.compare_digest(supplied.encode(), TOKEN.encode())
+
+
+class NodeClient:
+    """JSON requests to one node over a connection kept open between them."""
+
+    TIMEOUT = 5
+
+    def __init__(self, url, token=TOKEN):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Invalid node URL {url!r}")
+        self.url = url
+        self._parts = parts
+        self._prefix = parts.path.rstrip("/")
+        self._headers = {"Content-Type": "application/json"}
+        if token:
+            self._headers[TOKEN_HEADER] = token
+        self._conn = None
+
+    def _connect(self):
+        connection = (
+            http.client.HTTPSConnection
+            if self._parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        return connection(self._parts.hostname, self._parts.port, timeout=self.TIMEOUT)
+
+    def request(self, method, path, body=None):
+        data = None if body is None else json.dumps(body)
+        # The kept connection may have been closed by the node, retry once on a new one
+        for attempt in (1, 2):
+            if self._conn is None:
+                self._conn = self._connect()
+            try:
+                self._conn.request(method, self._prefix + path, data, self._headers)
+                response = self._conn.getresponse()
+                text = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                self.close()
+                if attempt == 2:
+                    raise NodeError(f"{self.url} unreachable: {e}")
+                continue
+            if response.status != 200:
+                raise NodeError(f"{self.url}{path} answered {response.status}: {text[:200]!r}")
+            try:
+                answer = json.loads(text)
+            except ValueError:
+                raise NodeError(f"{self.url}{path} answered with invalid JSON: {text[:200]!r}")
+            if not isinstance(answer, dict):
+                raise NodeError(f"{self.url}{path} answered {type(answer).__name__}, not an object")
+            return answer
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class Node:
+    """What the coordinator knows about one node."""
+
+    def __init__(self, node_id, name, url):
+        self.id = node_id
+        self.name = name
+        self.client = NodeClient(url)
+        # Lines and schedules the node has acknowledged, None until the
+        # first full sync
+        self.pushed = None
+        self.state = None
+        self.last_seen = None
+        self.error = None
+
+
+def _delta(pushed, desired, kind):
+    changed = [row for key, row in desired[kind].items() if pushed[kind].get(key) != row]
+    deleted = [key for key in pushed[kind] if key not in desired[kind]]
+    return changed, deleted
+
+
+class Coordinator:
+    """Keeps every node's lines and schedules in step with the database.
+
+    ``changed()`` only wakes the worker, which waits ``SYNC_DELAY`` so a
+    burst of edits goes out as one request per node. Each node is sent the
+    difference between the database and what it last acknowledged, so a
+    node that was down gets everything it missed on the next attempt.
+    Without changes the worker polls each node's state every
+    ``STATE_INTERVAL`` seconds and retries nodes with unsent changes.
+    """
+
+    SYNC_DELAY = 0.5
+    STATE_INTERVAL = 30.0
+
+    def __init__(self, file=DATABASE):
+        self.file = file
+        self._nodes = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def load_nodes(self):
+        """(Re)read the node registry, keeping what's known about nodes
+        whose address didn't change."""
+        with SQLite(self.file) as db:
+            rows = db.execute("SELECT id, name, url FROM controller_nodes").fetchall()
+        with self._lock:
+            nodes = {}
+            for row in rows:
+                node = self._nodes.get(row["id"])
+                if node is None or node.client.url != row["url"]:
+                    if node is not None:
+                        node.client.close()
+                    node = Node(row["id"], row["name"], row["url"])
+                node.name = row["name"]
+                nodes[row["id"]] = node
+            for node_id, node in self._nodes.items():
+                if node_id not in nodes:
+                    node.client.close()
+            self._nodes = nodes
+        self.changed()
+
+    def changed(self):
+        self._changed.set()
+
+    def desired(self):
+        """``{node_id: {"lines": {id: row}, "schedules": {id: row}}}`` from
+        the database."""
+        with self._lock:
+            desired = {node_id: {"lines": {}, "schedules": {}} for node_id in self._nodes}
+        with SQLite(self.file) as db:
+            lines = db.execute(
+                f"""
+                SELECT node_id, {", ".join(LINE_FIELDS)} FROM watering_lines
+                WHERE node_id IS NOT NULL
+                """
+            ).fetchall()
+            schedules = db.execute(
+                """
+                SELECT wl.node_id, ws.id, ws.watering_line_id, ws.start_minute,
+                    ws.end_minute, ws.repeat_days
+                FROM watering_schedule ws
+                INNER JOIN watering_lines wl ON ws.watering_line_id = wl.id
+                WHERE wl.node_id IS NOT NULL
+                """
+            ).fetchall()
+        for kind, rows in (("lines", lines), ("schedules", schedules)):
+            for row in rows:
+                node_id = row.pop("node_id")
+                if node_id in desired:
+                    desired[node_id][kind][row["id"]] = row
+        return desired
+
+    def sync(self):
+        """Push each node whatever it hasn't acknowledged yet."""
+        desired = self.desired()
+        with self._lock:
+            nodes = list(self._nodes.values())
+        for node in nodes:
+            target = desired.get(node.id)
+            if target is None:
+                continue
+            if node.pushed is None:
+                body = {
+                    "full": True,
+                    "lines": list(target["lines"].values()),
+                    "schedules": list(target["schedules"].values()),
+                }
+            else:
+                lines, deleted_lines = _delta(node.pushed, target, "lines")
+                schedules, deleted_schedules = _delta(node.pushed, target, "schedules")
+                if not (lines or deleted_lines or schedules or deleted_schedules):
+                    continue
+                body = {
+                    "full": False,
+                    "lines": lines,
+                    "schedules": schedules,
+                    "deleted_lines": deleted_lines,
+                    "deleted_schedules": deleted_schedules,
+                }
+            try:
+                with NODE_SYNC.time(node=node.name):
+                    answer = self._send(node, "POST", "/api/node/sync", body)
+            except NodeError:
+                continue
+            node.pushed = target
+            self._update_state(node, answer.get("state"))
+
+    def poll(self):
+        with self._lock:
+            nodes = list(self._nodes.values())
+        for node in nodes:
+            try:
+                self._update_state(node, self._send(node, "GET", "/api/node/state"))
+            except NodeError:
+                pass
+
+    def _update_state(self, node, state):
+        node.state = state
+        if state is None or node.pushed is None:
+            return
+        # The node lost or gained rows behind our back, e.g. its database
+        # was replaced, so start again from a full sync
+        if (
+            state.get("line_count") != len(node.pushed["lines"])
+            or state.get("schedule_count") != len(node.pushed["schedules"])
+        ):
+            logger.warning(f"Controller node {node.name} is out of step, resyncing it")
+            node.pushed = None
+            self.changed()
+
+    def _send(self, node, method, path, body=None):
+        try:
+            answer = node.client.request(method, path, body)
+        except NodeError as e:
+            NODE_REQUESTS.inc(node=node.name, result="error")
+            if node.error is None:
+                logger.warning(f"Controller node {node.name} failed: {e}")
+            node.error = str(e)
+            raise
+        NODE_REQUESTS.inc(node=node.name, result="ok")
+        if node.error is not None:
+            logger.info(f"Controller node {node.name} is back")
+        node.error = None
+        node.last_seen = time.time()
+        return answer
+
+    def nodes(self):
+        """Every node and its last known state, for the nodes page."""
+        with self._lock:
+            nodes = list(self._nodes.values())
+        return [
+            {
+                "id": node.id,
+                "name": node.name,
+                "url": node.client.url,
+                "reachable": node.error is None and node.last_seen is not None,
+                "error": node.error,
+                "last_seen": node.last_seen,
+                "synced": node.pushed is not None,
+                "state": node.state,
+            }
+            for node in sorted(nodes, key=lambda node: node.name)
+        ]
+
+    def run(self):
+        while not self._stopping:
+            try:
+                if self._changed.wait(self.STATE_INTERVAL):
+                    # Let the rest of a burst of edits arrive first
+                    time.sleep(self.SYNC_DELAY)
+                    self._changed.clear()
+                    self.sync()
+                elif not self._stopping:
+                    self.sync()
+                    self.poll()
+            except Exception:
+                # A node answering nonsense mustn't stop syncing the others
+                logger.exception("Node sync failed")
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._changed.set()
+        self._thread.join()
+        self._thread = None
+
+
+def _rows(payload, key, fields):
+    rows = payload.get(key) or []
+    if not isinstance(rows, list):
+        raise ValueError(f"{key} must be a list")
+    try:
+        return [tuple(row[field] for field in fields) for row in rows]
+    except (KeyError, TypeError):
+        raise ValueError(f"every entry in {key} needs {', '.join(fields)}")
+
+
+def _ids(payload, key):
+    ids = payload.get(key) or []
+    if not isinstance(ids, list) or not all(isinstance(value, int) for value in ids):
+        raise ValueError(f"{key} must be a list of ids")
+    return [(value,) for value in ids]
+
+
+def apply_sync(db, payload):
+    """Apply a sync request from the coordinator in the transaction ``db``.
+
+    The coordinator's ids are kept, so later deltas can name the rows.
+    Returns how many rows were written and deleted.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("Expected a JSON object")
+    lines = _rows(payload, "lines", LINE_FIELDS)
+    schedules = _rows(payload, "schedules", SCHEDULE_FIELDS)
+    deleted_lines = _ids(payload, "deleted_lines")
+    deleted_schedules = _ids(payload, "deleted_schedules")
+    if payload.get("full"):
+        # The coordinator owns every line on this node
+        db.execute("DELETE FROM watering_schedule")
+        db.execute("DELETE FROM watering_lines")
+    db.executemany("DELETE FROM watering_schedule WHERE id = ?", deleted_schedules)
+    db.executemany("DELETE FROM watering_schedule WHERE watering_line_id = ?", deleted_lines)
+    db.executemany("DELETE FROM watering_lines WHERE id = ?", deleted_lines)
+    db.executemany(
+        f"""
+        INSERT OR REPLACE INTO watering_lines ({", ".join(LINE_FIELDS)})
+        VALUES ({", ".join("?" * len(LINE_FIELDS))})
+        """,
+        lines,
+    )
+    db.executemany(
+        f"""
+        INSERT OR REPLACE INTO watering_schedule ({", ".join(SCHEDULE_FIELDS)})
+        VALUES ({", ".join("?" * len(SCHEDULE_FIELDS))})
+        """,
+        schedules,
+    )
+    return {
+        "written": len(lines) + len(schedules),
+        "deleted": len(deleted_lines) + len(deleted_schedules),
+    }
@@ -0,0 +1,18 @@
+# Settings for serving wsgi:app, see wsgi.py
+import os
+import threading
+
+bind = os.environ.get("WATERING_BIND", f"0.0.0.0:{os.environ.get('WATERING_PORT', 5000)}")
+workers = int(os.environ.get("WATERING_WORKERS", 2))
+# Each open /events stream holds one thread of its worker, see post_worker_init
+worker_class = "gthread"
+threads = int(os.environ.get("WATERING_THREADS", 8))
+
+
+def post_worker_init(worker):
+    # Streams past half the threads are answered 503, so the rest are
+    # left for pages however many browser tabs are open. A single thread
+    # still allows one.
+    import main
+
+    main.worker_streams = threading.BoundedSemaphore(max(1, worker.cfg.threads // 2))
@@ -0,0 +1,134 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+
+import metrics
+from utils import DATABASE, SQLite
+
+logger = logging.getLogger(__name__)
+
+START = "start"
+STOP = "stop"
+SKIPPED = "skipped"
+
+_STOP = object()
+
+HISTORY_FLUSHES = metrics.histogram(
+    "watering_history_flush_seconds", "Time to write one batch of history events."
+)
+HISTORY_DROPPED = metrics.counter(
+    "watering_history_dropped_total", "History events lost to failed writes."
+)
+
+
+class HistoryWriter:
+    """Background writer for the watering_events log and its daily rollups.
+
+    ``record()`` only queues the event, so the scheduler never waits on the
+    disk. The worker writes a batch in one transaction once ``BATCH_SIZE``
+    events are waiting or ``FLUSH_INTERVAL`` seconds after the first of
+    them, updating watering_daily in the same transaction.
+
+    Events recorded while the worker isn't running are ignored, so a
+    simulation can replay schedules without touching the log.
+    """
+
+    BATCH_SIZE = 100
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, file=DATABASE):
+        self.file = file
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def record(self, line_id, gpio_pin, event, at, minutes=None):
+        # Only runs of a known line are logged, not manual switching
+        if self._thread is None or line_id is None:
+            return
+        self._queue.put((line_id, gpio_pin, event, at, minutes))
+
+    def _collect(self):
+        """Block for one event, then gather more until the batch is full or
+        the flush interval has passed."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.FLUSH_INTERVAL
+        while batch[-1] is not _STOP and len(batch) < self.BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        """Append ``batch`` to the log and fold it into the rollups."""
+        rollups = {}
+        for line_id, _, event, at, minutes in batch:
+            # A run's minutes belong to the day it started
+            started = at - datetime.timedelta(minutes=minutes) if event == STOP else at
+            day = started.date()
+            totals = rollups.setdefault((day.isoformat(), line_id), [0, 0.0, 0])
+            if event == START:
+                totals[0] += 1
+            elif event == STOP:
+                totals[1] += minutes
+            elif event == SKIPPED:
+                totals[2] += 1
+
+        with HISTORY_FLUSHES.time(), SQLite(self.file) as db:
+            db.executemany(
+                """
+                INSERT INTO watering_events
+                    (watering_line_id, gpio_pin, event, at, minutes)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                [
+                    (line_id, gpio_pin, event, at.isoformat(timespec="seconds"), minutes)
+                    for line_id, gpio_pin, event, at, minutes in batch
+                ],
+            )
+            db.executemany(
+                """
+                INSERT INTO watering_daily (day, watering_line_id, runs, minutes, skipped)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (day, watering_line_id) DO UPDATE SET
+                    runs = runs + excluded.runs,
+                    minutes = minutes + excluded.minutes,
+                    skipped = skipped + excluded.skipped
+                """,
+                [(day, line_id, *totals) for (day, line_id), totals in rollups.items()],
+            )
+
+    def _flush(self, batch):
+        try:
+            self.write(batch)
+        except Exception:
+            HISTORY_DROPPED.inc(len(batch))
+            logger.exception(f"Failed to write {len(batch)} history events")
+
+    def run(self):
+        while True:
+            batch = self._collect()
+            stopping = batch[-1] is _STOP
+            if stopping:
+                batch.pop()
+            if batch:
+                self._flush(batch)
+            if stopping:
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write everything already recorded, then stop the worker."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
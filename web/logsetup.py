@@ -0,0 +1,53 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# Extra fields shown after the message when a record carries them, e.g.
+# logger.info("Watering started", extra={"pin": 16, "line": "Ferns"})
+FIELDS = ("action", "pin", "pins", "line", "scheduled", "actual", "late_s")
+
+# Minimum level logged, e.g. WATERING_LOG_LEVEL=DEBUG for every GPIO write
+LEVEL = os.environ.get("WATERING_LOG_LEVEL", "INFO").upper()
+
+_listener = None
+
+
+class StructuredFormatter(logging.Formatter):
+    """``LEVEL:logger:message`` followed by ``key=value`` for each field in
+    FIELDS set on the record."""
+
+    def format(self, record):
+        text = super().format(record)
+        fields = [
+            f"{field}={getattr(record, field)}"
+            for field in FIELDS
+            if getattr(record, field, None) is not None
+        ]
+        return f"{text} {' '.join(fields)}" if fields else text
+
+
+def setup_logging(level=LEVEL, stream=None):
+    """Send every log record through a queue to one writer thread.
+
+    Logging calls only build the record and enqueue it, so the scheduler
+    and GPIO paths never wait on the terminal or journald.
+    Records below ``level`` are dropped before they are queued.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(StructuredFormatter("%(levelname)s:%(name)s:%(message)s"))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    # Write out whatever is still queued when the process exits
+    atexit.register(_listener.stop)
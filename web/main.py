@@ -1,147 +1,641 @@
-from flask import Flask, render_template, redirect, request, url_for
-from utils import SQLite
-import logging
-import schedule
 import time
+
+# Startup is timed from here, before the slow imports, to serving requests
+STARTUP_BEGAN = time.perf_counter()
+
+from flask import (
+    Flask,
+    Response,
+    g,
+    jsonify,
+    render_template,
+    redirect,
+    request,
+    url_for,
+)
+from utils import (
+    SQLite,
+    days_to_mask,
+    mask_to_days,
+    minute_to_time,
+    time_to_minute,
+    DAYS,
+)
+from createdb import migrate
+from scheduler import Scheduler, Job, MINUTES_PER_DAY, minute_of_week
+from occupancy import OccupancyIndex
+from reconcile import ScheduleWindows
+from moisture import MoistureStore, FileSource, adjusted_minutes, parse_readings
+from weather import WeatherAdjuster
+from settings import Settings, DEFAULTS
+import functools
+import inspect
+import logging
 import datetime
+import os
+import signal
+import sys
 import threading
-from pin_controller import (
-    enable_all_lines,
-    activate_line,
-    deactivate_line,
-    deactivate_all_lines,
+import metrics
+import pins
+import bulk
+import federation
+from actuator import Actuator
+from zones import ZoneDispatcher, QUEUED, STARTED, STOPPED
+from events import EventBus, format_event
+from history import HistoryWriter, START, STOP, SKIPPED
+from status import StatusIndex, LineStatus, IDLE, WAITING, WATERING
+from cache import PageCache, CACHE_LOOKUPS
+from control import ControlClient, CONTROL_CALLS
+from logsetup import setup_logging
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Set by wsgi.py. Web workers leave the scheduler, the relays and the
+# in-memory state to the controller process and send it commands instead.
+WEB_WORKER = os.environ.get("WATERING_ROLE") == "web"
+control = ControlClient() if WEB_WORKER else None
+
+# WATERING_PIN_CONTROLLER=dummy runs without Raspberry Pi hardware
+pin_controller = pins.load_controller("dummy" if WEB_WORKER else None)
+
+app = Flask(__name__)
+
+scheduler = Scheduler()
+occupancy = OccupancyIndex()
+# Every relay switch goes through this one thread
+actuator = Actuator(pin_controller)
+settings = Settings()
+# Decides which scheduled runs can water at the same time
+dispatcher = ZoneDispatcher(actuator, scheduler)
+# Live updates for the /events stream
+event_bus = EventBus()
+# Log of runs, written in batches off the scheduler thread
+history = HistoryWriter()
+# Each line's state and next start and stop, for the home page
+status = StatusIndex()
+# Rendered list pages, dropped whenever lines or schedules are written
+page_cache = PageCache()
+# Rolling soil moisture per line, can shorten or skip runs
+soil_moisture = MoistureStore()
+# Today's run lengths from the weather feed, if there is one
+weather = WeatherAdjuster()
+# Pushes the lines bound to other controllers to them
+coordinator = federation.Coordinator()
+
+
+# What the controller runs for the web workers, by name
+commands = {}
+
+
+def in_controller(func):
+    """Run ``func`` in the process that owns the scheduler and the relays.
+
+    In a web worker calls go to the controller over the control socket, so
+    arguments and results have to be plain JSON values.
+    """
+    commands[func.__name__] = func
+    if not WEB_WORKER:
+        return func
+    if inspect.isgeneratorfunction(func):
+        return functools.wraps(func)(
+            lambda *args, **kwargs: control.stream(func.__name__, *args, **kwargs)
+        )
+    return functools.wraps(func)(
+        lambda *args, **kwargs: control.call(func.__name__, *args, **kwargs)
+    )
+
+
+def on_maintenance_mode(enabled):
+    # Nothing keeps running when maintenance is switched on or off
+    dispatcher.clear()
+    actuator.deactivate_all_lines()
+    status.reset_states()
+    event_bus.publish("maintenance", {"enabled": enabled})
+
+
+def on_valve_change(transitions):
+    for gpio_pin, active in transitions.items():
+        event_bus.publish("valve", {"gpio_pin": gpio_pin, "active": active})
+
+
+def on_run(event, run, at):
+    if event == QUEUED:
+        status.set_state(run.line_id, WAITING)
+    elif event == STARTED:
+        history.record(run.line_id, run.pin, START, at)
+        until = None
+        if run.minutes is not None:
+            until = at + datetime.timedelta(minutes=run.minutes)
+        status.set_state(run.line_id, WATERING, until)
+    elif event == STOPPED:
+        # Dropped from the queue before its valve opened
+        if run.started is not None:
+            minutes = (at - run.started).total_seconds() / 60
+            history.record(run.line_id, run.pin, STOP, at, minutes)
+        status.set_state(run.line_id, IDLE)
+
+
+settings.subscribe("maintenance_mode", on_maintenance_mode)
+actuator.subscribe(on_valve_change)
+dispatcher.subscribe(on_run)
+settings.subscribe("watering_when_GPIO_high", pin_controller.set_polarity)
+settings.subscribe("supply_capacity", dispatcher.set_capacity)
+settings.subscribe("supply_capacity", lambda capacity: page_cache.invalidate())
+for key in ("moisture_shorten", "moisture_skip", "reference_et"):
+    settings.subscribe(key, lambda value: page_cache.invalidate())
+settings.subscribe("reference_et", weather.set_reference_et)
+
+REQUESTS = metrics.counter(
+    "watering_http_requests_total",
+    "HTTP requests handled, by route and status.",
+    ("method", "route", "status"),
 )
+REQUEST_LATENCY = metrics.histogram(
+    "watering_http_request_duration_seconds",
+    "Time to build each HTTP response, by route.",
+    ("method", "route"),
+)
+STARTUP = metrics.histogram(
+    "watering_startup_seconds",
+    "Time from starting the process to being ready to serve requests.",
+    buckets=(0.5, 1, 2, 5, 10, 30),
+)
+SCHEDULE_LOAD = metrics.histogram(
+    "watering_schedule_load_seconds",
+    "Time to rebuild scheduler jobs, for all schedules or a single one.",
+    ("scope",),
+)
+# Recorded by the process serving the request, everything else by the one
+# running the scheduler
+WORKER_METRICS = {
+    REQUESTS.name, REQUEST_LATENCY.name, CACHE_LOOKUPS.name, CONTROL_CALLS.name
+}
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_LATENCY.observe(
+        time.perf_counter() - g.request_started, method=request.method, route=route
+    )
+    REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+    return response
+
+
+SCHEDULE_JOBS_QUERY = """
+    SELECT ws.id, ws.watering_line_id, wl.gpio_pin, wl.name, wl.flow,
+        wl.crop_coefficient, ws.repeat_days, ws.start_minute, ws.end_minute
+    FROM watering_schedule ws
+    INNER JOIN watering_lines wl ON ws.watering_line_id = wl.id
+    WHERE wl.node_id IS NULL
+"""
+
+
+def schedule_jobs(schedule_item):
+    """Build the start and stop jobs for one watering_schedule row."""
+    line_id = schedule_item["watering_line_id"]
+    gpio_pin = schedule_item["gpio_pin"]
+    name = schedule_item["name"]
+    flow = schedule_item["flow"]
+    start_minute = schedule_item["start_minute"]
+    end_minute = schedule_item["end_minute"]
+    if end_minute <= start_minute:
+        # Runs past midnight, stop on the following day
+        end_minute += MINUTES_PER_DAY
+
+    # Schedule the start and stop for each day
+    jobs = []
+    for day_index in mask_to_days(schedule_item["repeat_days"]):
+        day_minute = day_index * MINUTES_PER_DAY
+        jobs.append(
+            Job(
+                day_minute + start_minute,
+                start_watering,
+                gpio_pin=gpio_pin,
+                name=name,
+                flow=flow,
+                minutes=end_minute - start_minute,
+                line_id=line_id,
+                schedule_id=schedule_item["id"],
+            )
+        )
+        jobs.append(
+            Job(
+                day_minute + end_minute,
+                stop_watering,
+                gpio_pin=gpio_pin,
+                name=name,
+                line_id=line_id,
+            )
+        )
+    return jobs
 
 
-logging.basicConfig(level=logging.INFO)
+def status_jobs(schedule_item, jobs):
+    """``(line_id, starts, stops)`` of a schedule, for the status index."""
+    return (
+        schedule_item["watering_line_id"],
+        [job for job in jobs if job.func is start_watering],
+        [job for job in jobs if job.func is stop_watering],
+    )
 
-app = Flask(__name__)
 
+def load_schedules():
+    """Rebuild every job from the database."""
+    with SCHEDULE_LOAD.time(scope="all"):
+        with SQLite() as db:
+            schedules = db.execute(SCHEDULE_JOBS_QUERY).fetchall()
+
+        jobs = {
+            schedule_item["id"]: schedule_jobs(schedule_item)
+            for schedule_item in schedules
+        }
+        scheduler.replace_all(jobs)
+        weather.set_schedules(schedules)
+        status.replace_all(
+            {
+                schedule_item["id"]: status_jobs(schedule_item, jobs[schedule_item["id"]])
+                for schedule_item in schedules
+            }
+        )
+    event_bus.publish("schedules", {"scope": "all", "count": len(schedules)})
+    coordinator.changed()
+    logger.info(f"Loaded {len(schedules)} watering schedules.")
+    reconcile(schedules)
 
-def run_schedule():
-    while True:
-        schedule.run_pending()
-        time.sleep(1)  # Check every second
 
+def load_schedule(schedule_id, reconcile_runs=True):
+    """Add, replace or remove the jobs of a single schedule, then bring the
+    valves of its line in line with it unless ``reconcile_runs`` is False."""
+    with SCHEDULE_LOAD.time(scope="one"):
+        with SQLite() as db:
+            schedule_item = db.execute(
+                SCHEDULE_JOBS_QUERY + "AND ws.id = ?", (schedule_id,)
+            ).fetchone()
 
-def load_schedules():
+        if schedule_item:
+            jobs = schedule_jobs(schedule_item)
+            scheduler.replace(schedule_id, jobs)
+            status.set_schedule(schedule_id, *status_jobs(schedule_item, jobs))
+        else:
+            scheduler.remove(schedule_id)
+            status.set_schedule(schedule_id)
+        weather.set_schedule(schedule_id, schedule_item)
+    event_bus.publish("schedules", {"scope": "one", "id": schedule_id})
+    coordinator.changed()
+    if reconcile_runs:
+        # The line it was on before an edit, if a run of it is still going
+        line_ids = {run.line_id for run in dispatcher.runs() if run.schedule_id == schedule_id}
+        if schedule_item:
+            line_ids.add(schedule_item["watering_line_id"])
+        reconcile_lines(line_ids)
+
+
+def load_line_schedules(line_id):
+    """Refresh the jobs of every schedule on a watering line."""
     with SQLite() as db:
-        schedules = db.execute(
-            """
-            SELECT wl.gpio_pin, wl.name, ws.repeat_days, ws.start_time, ws.end_time
-            FROM watering_schedule ws
-            INNER JOIN watering_lines wl ON ws.watering_line_id = wl.id
-        """
+        schedule_ids = [
+            row["id"]
+            for row in db.execute(
+                "SELECT id FROM watering_schedule WHERE watering_line_id = ?",
+                (line_id,),
+            )
+        ]
+    for schedule_id in schedule_ids:
+        load_schedule(schedule_id, reconcile_runs=False)
+    # Also when it has no schedules left, to close a run still going
+    reconcile_lines([line_id])
+
+
+def load_lines():
+    """Refresh the lines shown on the home page."""
+    with SQLite() as db:
+        lines = db.execute(
+            "SELECT id, name, gpio_pin FROM watering_lines WHERE node_id IS NULL"
         ).fetchall()
+    status.set_lines((line["id"], line["name"], line["gpio_pin"]) for line in lines)
+    coordinator.changed()
 
-    weakdays_dict = {
-        "Mon": "monday",
-        "Tue": "tuesday",
-        "Wed": "wednesday",
-        "Thu": "thursday",
-        "Fri": "friday",
-        "Sat": "saturday",
-        "Sun": "sunday",
-    }
 
-    # Convert each schedule into jobs
-    for schedule_item in schedules:
-        gpio_pin = schedule_item["gpio_pin"]
-        name = schedule_item["name"]
-        days = schedule_item["repeat_days"].split(",")
-        start_time = schedule_item["start_time"]
-        end_time = schedule_item["end_time"]
-
-        # Schedule the start and stop for each day
-        for day_abrev, day_name in weakdays_dict.items():
-            if day_abrev in days:
-                getattr(schedule.every(), day_name).at(start_time).do(
-                    start_watering, gpio_pin=gpio_pin, name=name
-                )
-                getattr(schedule.every(), day_name).at(end_time).do(
-                    stop_watering, gpio_pin=gpio_pin, name=name
-                )
-    print(f"Loaded {len(schedules)} watering schedules.")
-
-
-def start_watering(gpio_pin=-1, name="No Name"):
-    if maintenance_check():
-        print(
-            f"Maintenance mode is active. Skipping watering starting for {name}, (PIN {
-                gpio_pin})."
-        )
+def reconcile_lines(line_ids):
+    """Reconcile the runs and schedules of just these lines."""
+    line_ids = set(line_ids)
+    if not line_ids:
         return
-    activate_line(gpio_pin)
-    print(f"{datetime.datetime.now()
-             } - Watering started for {name}, (PIN {gpio_pin})")
+    with SQLite() as db:
+        schedules = db.execute(
+            SCHEDULE_JOBS_QUERY
+            + f"AND ws.watering_line_id IN ({', '.join('?' * len(line_ids))})",
+            tuple(line_ids),
+        ).fetchall()
+    reconcile(schedules, line_ids)
+
 
+def reconcile(schedules, line_ids=None):
+    """Bring the valves in line with what the schedules say right now.
 
-def stop_watering(gpio_pin=-1, name="No Name"):
+    Jobs only fire at the next start or stop, so after a restart or reload
+    in the middle of a run the line would otherwise stay dry until the next
+    day. Lines inside a watering window are started for what is left of
+    it, and scheduled runs whose window has gone are stopped. Runs whose
+    schedule was deleted, or whose line moved to another pin, are closed
+    however they were started. ``line_ids`` limits it to the runs of those
+    lines, when ``schedules`` only holds theirs.
+    """
     if maintenance_check():
-        print(
-            f"Maintenance mode is active. Skipping watering endding for {name}, (PIN {
-                gpio_pin})."
+        return
+    now = scheduler.now()
+    active = ScheduleWindows(schedules).active(minute_of_week(now))
+    pins = {schedule_item["id"]: schedule_item["gpio_pin"] for schedule_item in schedules}
+    # Stop first, so runs that are over don't hold supply capacity
+    covered = {schedule_item["gpio_pin"] for schedule_item, _, _ in active}
+    for run in dispatcher.runs():
+        if line_ids is not None and run.line_id not in line_ids:
+            continue
+        fields = {"pin": run.pin, "line": run.name, "action": "reconcile"}
+        if run.schedule_id is not None and pins.get(run.schedule_id) != run.pin:
+            if dispatcher.cancel(run.pin):
+                logger.info("Watering stopped, its schedule was removed or moved", extra=fields)
+        elif run.pin not in covered and dispatcher.stop(run.pin):
+            logger.info("Watering stopped, its schedule no longer covers now", extra=fields)
+    for schedule_item, minutes_in, minutes_left in active:
+        gpio_pin = schedule_item["gpio_pin"]
+        line_id = schedule_item["watering_line_id"]
+        # Already watered this window, e.g. a run shortened for damp soil
+        window_began = now.replace(second=0, microsecond=0) - datetime.timedelta(
+            minutes=minutes_in
         )
+        if dispatcher.started_since(gpio_pin, window_began):
+            continue
+        length = weather.minutes(
+            schedule_item["id"], window_began.date(), minutes_in + minutes_left
+        )
+        _, run_minutes = moisture_minutes(line_id, length - minutes_in)
+        if run_minutes <= 0:
+            continue
+        fields = {"pin": gpio_pin, "line": schedule_item["name"], "action": "reconcile"}
+        if dispatcher.start(
+            gpio_pin,
+            schedule_item["name"],
+            schedule_item["flow"],
+            run_minutes,
+            line_id,
+            timed=run_minutes != minutes_left,
+            schedule_id=schedule_item["id"],
+        ):
+            logger.info(f"Watering started mid-window, {run_minutes} minutes left", extra=fields)
+
+
+def moisture_minutes(line_id, minutes):
+    """``(average, minutes)``, the line's soil moisture and how long to water
+    given it, 0 minutes to skip."""
+    average = soil_moisture.average(line_id, scheduler.now())
+    return average, adjusted_minutes(
+        average, minutes, settings.get("moisture_shorten"), settings.get("moisture_skip")
+    )
+
+
+def start_watering(
+    gpio_pin=-1, name="No Name", flow=1, minutes=None, line_id=None, schedule_id=None
+):
+    status.job_fired(line_id)
+    fields = {"pin": gpio_pin, "line": name, "action": "start"}
+    if maintenance_check():
+        logger.info("Maintenance mode is active, skipping watering start", extra=fields)
+        history.record(line_id, gpio_pin, SKIPPED, scheduler.now())
+        return
+    # Looked up from the lengths worked out for every schedule for today
+    length = weather.minutes(schedule_id, scheduler.now().date(), minutes)
+    if length == 0:
+        logger.info("No watering needed in today's weather, skipping", extra=fields)
+        history.record(line_id, gpio_pin, SKIPPED, scheduler.now())
+        return
+    average, run_minutes = moisture_minutes(line_id, length)
+    if run_minutes == 0:
+        logger.info(f"Soil moisture is {average:.0f}%, skipping watering", extra=fields)
+        history.record(line_id, gpio_pin, SKIPPED, scheduler.now())
         return
-    deactivate_line(gpio_pin)
-    print(f"{datetime.datetime.now()
-             } - Watering stopped for {name}, (PIN {gpio_pin})")
+    timed = run_minutes != minutes
+    if timed:
+        logger.info(f"Watering {run_minutes} of {minutes} scheduled minutes", extra=fields)
+    # Runs alongside other lines if the supply allows, otherwise waits
+    if dispatcher.start(
+        gpio_pin, name, flow, run_minutes, line_id, timed=timed, schedule_id=schedule_id
+    ):
+        logger.info("Watering started", extra=fields)
+
+
+def stop_watering(gpio_pin=-1, name="No Name", line_id=None):
+    status.job_fired(line_id)
+    fields = {"pin": gpio_pin, "line": name, "action": "stop"}
+    if maintenance_check():
+        logger.info("Maintenance mode is active, skipping watering stop", extra=fields)
+        return
+    if dispatcher.stop(gpio_pin):
+        logger.info("Watering stopped", extra=fields)
 
 
+@in_controller
 def reload_schedules():
-    schedule.clear()  # Clear existing jobs
-    load_schedules()  # Reload from the database
+    load_schedules()  # Rebuild every job from the database
 
 
-def add_schedule(watering_line_id, start_time, end_time, repeat_days):
-    with SQLite() as db:
+def schedule_conflicts(watering_line_id, start_minute, end_minute, days, ignore=None):
+    """True if the run overlaps another on its line. Runs beyond the supply
+    capacity are accepted, the dispatcher queues them."""
+    return occupancy.conflicts(
+        watering_line_id, start_minute, end_minute, days, ignore=ignore
+    )
+
+
+@in_controller
+def add_schedule(watering_line_id, start_minute, end_minute, repeat_days):
+    days = mask_to_days(repeat_days)
+
+    with occupancy.lock:
         # Check for overlapping schedules
-        # To overlap both must start before the other ends
-        existing = db.execute(
-            """
-            SELECT *
-            FROM watering_schedule
-            WHERE start_time < ?
-            AND end_time > ?
+        if schedule_conflicts(watering_line_id, start_minute, end_minute, days):
+            raise ValueError("Schedule conflicts with an existing schedule.")
+
+        with SQLite() as db:
+            # Insert new schedule if no conflicts
+            schedule_id = db.execute(
+                """
+            INSERT INTO watering_schedule (watering_line_id, start_minute, end_minute, repeat_days)
+            VALUES (?, ?, ?, ?)
             """,
-            (
-                end_time,
-                start_time,
-            ),
-        ).fetchall()
+                (watering_line_id, start_minute, end_minute, repeat_days),
+            ).lastrowid
+        page_cache.invalidate()
+        load_occupancy_schedule(schedule_id)
+    load_schedule(schedule_id)  # Add the jobs for the new schedule
+
+
+@in_controller
+def update_schedule(schedule_id, watering_line_id, start_minute, end_minute, repeat_days):
+    days = mask_to_days(repeat_days)
+
+    with occupancy.lock:
+        # Check for overlapping schedules, other than this one's old times
+        if schedule_conflicts(
+            watering_line_id, start_minute, end_minute, days, ignore=schedule_id
+        ):
+            raise ValueError("Schedule conflicts with an existing schedule.")
+
+        with SQLite() as db:
+            # Update the schedule
+            db.execute(
+                """
+            UPDATE watering_schedule
+            SET watering_line_id = ?, start_minute = ?, end_minute = ?, repeat_days = ?
+            WHERE id = ?
+            """,
+                (watering_line_id, start_minute, end_minute, repeat_days, schedule_id),
+            )
+        page_cache.invalidate()
+        load_occupancy_schedule(schedule_id)
 
-    used = {day for row in existing for day in row["repeat_days"].split()}
+    load_schedule(schedule_id)  # Replace the jobs for this schedule
 
-    if used.intersection(set(repeat_days.split())):
-        raise ValueError("Schedule conflicts with an existing schedule.")
 
+@in_controller
+def remove_schedule(schedule_id):
     with SQLite() as db:
-        # Insert new schedule if no conflicts
-        db.execute(
-            """
-        INSERT INTO watering_schedule (watering_line_id, start_time, end_time, repeat_days)
-        VALUES (?, ?, ?, ?)
-        """,
-            (watering_line_id, start_time, end_time, repeat_days),
-        )
-    reload_schedules()  # Reload schedules to reflect the change
+        db.execute("DELETE FROM watering_schedule WHERE id = ?", (schedule_id,))
+    page_cache.invalidate()
+    occupancy.remove(schedule_id)
+    load_schedule(schedule_id)  # Drop the jobs for this schedule
+
+
+OCCUPANCY_QUERY = """
+    SELECT ws.id, ws.watering_line_id, ws.start_minute, ws.end_minute, ws.repeat_days
+    FROM watering_schedule ws
+    INNER JOIN watering_lines wl ON ws.watering_line_id = wl.id
+"""
+
+
+def occupancy_entry(row):
+    return (
+        row["id"],
+        row["watering_line_id"],
+        row["start_minute"],
+        row["end_minute"],
+        mask_to_days(row["repeat_days"]),
+    )
+
+
+def load_occupancy():
+    """Rebuild the conflict index from every schedule that can fire."""
+    with SQLite() as db:
+        schedules = db.execute(OCCUPANCY_QUERY).fetchall()
+    occupancy.rebuild(occupancy_entry(row) for row in schedules)
+
+
+def load_occupancy_schedule(schedule_id):
+    """Add or replace one schedule in the conflict index."""
+    with SQLite() as db:
+        row = db.execute(OCCUPANCY_QUERY + "WHERE ws.id = ?", (schedule_id,)).fetchone()
+    if row:
+        occupancy.add(*occupancy_entry(row))
+    else:
+        occupancy.remove(schedule_id)
+
+
+@app.template_filter("minute_time")
+def minute_time_filter(minute):
+    return minute_to_time(minute)
+
+
+@app.template_filter("day_names")
+def day_names_filter(repeat_days):
+    return [DAYS[index] for index in mask_to_days(repeat_days)]
+
+
+@in_controller
+def page_version():
+    return page_cache.current()
+
+
+def cached_page(view):
+    """Serve the view's rendered HTML from ``page_cache`` with an ETag, so
+    repeat views skip the queries and the render, or get a 304."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if WEB_WORKER:
+            # Writes bump the controller's version
+            page_cache.follow(*page_version())
+        key = request.full_path
+        entry = page_cache.get(key)
+        if entry is None:
+            version = page_cache.version
+            entry = page_cache.put(key, view(*args, **kwargs), version)
+        etag, body = entry
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype="text/html")
+        response.set_etag(etag)
+        return response
+
+    return wrapper
+
+
+@in_controller
+def line_states():
+    """``(version, [line, ...])`` of the status index, lines as dicts. The
+    version starts with the index's instance, as it counts from 0 again
+    when the controller restarts."""
+    version, lines = status.lines()
+    return f"{status.instance}-{version}", [line.to_dict() for line in lines]
 
 
 @app.route("/")
 def home():
-    """Home page with navigation links."""
-    return render_template("home.html")
+    """Home page with each line's status and navigation links."""
+    _, lines = line_states()
+    return render_template(
+        "home.html",
+        lines=[LineStatus.from_dict(line) for line in lines],
+        maintenance=maintenance_check(),
+    )
+
+
+@app.get("/status")
+def status_json():
+    """Each line's state and next start and stop as JSON.
+
+    The ETag is the status index's instance and version, so polling clients
+    get a 304 without the body being built, and never a stale one after a
+    restart.
+    """
+    version, lines = line_states()
+    etag = f"status-{version}"
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(maintenance_mode=maintenance_check(), lines=lines)
+    response.set_etag(etag)
+    return response
 
 
 @app.route("/schedules/")
+@cached_page
 def list_schedules():
     """List all watering schedules."""
     with SQLite() as db:
         schedules = db.execute("""
-        SELECT s.id, w.name AS watering_line, s.start_time, s.end_time, s.repeat_days
+        SELECT s.id, w.name AS watering_line, s.start_minute, s.end_minute, s.repeat_days
         FROM watering_schedule s
         JOIN watering_lines w ON s.watering_line_id = w.id
-        ORDER By s.start_time
+        ORDER By s.start_minute
         """).fetchall()
     return render_template("list_schedules.html", schedules=schedules)
 
@@ -157,24 +651,38 @@ def create_schedule():
         return render_template("create_schedule.html", watering_lines=watering_lines)
 
     # POST: Handle form submission
-    watering_line_id = int(request.form["watering_line_id"])
-    start_time = request.form["start_time"]
-    end_time = request.form["end_time"]
-    repeat_days = ",".join(request.form.getlist("repeat_days"))
-
     try:
-        add_schedule(watering_line_id, start_time, end_time, repeat_days)
+        add_schedule(*schedule_form())
     except ValueError as e:
         return f"Error {e}", 400
 
     return redirect(url_for("list_schedules"))
 
 
+def schedule_form():
+    """``(watering_line_id, start_minute, end_minute, repeat_days)`` from the
+    schedule form, ValueError if a field isn't valid."""
+    try:
+        watering_line_id = int(request.form["watering_line_id"])
+    except ValueError:
+        raise ValueError("Invalid watering line.")
+    minutes = []
+    for field in ("start_time", "end_time"):
+        try:
+            hours, minute = request.form[field].split(":")
+            if not (0 <= int(hours) < 24 and 0 <= int(minute) < 60):
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"Invalid {field.replace('_', ' ')}, expected HH:MM.")
+        minutes.append(time_to_minute(request.form[field]))
+    return watering_line_id, *minutes, days_to_mask(request.form.getlist("repeat_days"))
+
+
 @app.route("/schedules/edit/<int:schedule_id>", methods=["GET", "POST"])
 def edit_schedule(schedule_id):
     """Edit an existing watering schedule."""
-    with SQLite() as db:
-        if request.method == "GET":
+    if request.method == "GET":
+        with SQLite() as db:
             schedule = db.execute(
                 "SELECT * FROM watering_schedule WHERE id = ?", (schedule_id,)
             ).fetchone()
@@ -182,65 +690,345 @@ def edit_schedule(schedule_id):
                 "SELECT id, name FROM watering_lines"
             ).fetchall()
 
-            if not schedule:
-                return "Schedule not found", 404
+        if not schedule:
+            return "Schedule not found", 404
 
-            return render_template(
-                "edit_schedule.html", schedule=schedule, watering_lines=watering_lines
-            )
+        return render_template(
+            "edit_schedule.html", schedule=schedule, watering_lines=watering_lines
+        )
 
-        # POST: Handle form submission
-        watering_line_id = int(request.form["watering_line_id"])
-        start_time = request.form["start_time"]
-        end_time = request.form["end_time"]
-        repeat_days = ",".join(request.form.getlist("repeat_days"))
+    # POST: Handle form submission
+    try:
+        update_schedule(schedule_id, *schedule_form())
+    except ValueError as e:
+        return str(e), 400
 
-        # Check for overlapping schedules
-        existing = db.execute(
-            """
-        SELECT *
-        FROM watering_schedule
-        WHERE id != ?
-          AND watering_line_id = ?
-          AND (start_time < ? AND end_time > ?)
-          AND (
-              repeat_days LIKE '%' || ? || '%'
-          )
+    return redirect(url_for("list_schedules"))
+
+
+@app.route("/schedules/delete/<int:schedule_id>")
+def delete_schedule(schedule_id):
+    """Delete a watering schedule."""
+    remove_schedule(schedule_id)
+    return redirect(url_for("list_schedules"))
+
+
+@app.post("/schedules/reload")
+def reload_all_schedules():
+    """Rebuild every scheduled job from the database."""
+    reload_schedules()
+    return redirect(url_for("list_schedules"))
+
+
+def batch_error(error):
+    return jsonify(
+        errors=[{"row": row, "error": message} for row, message in error.errors]
+    ), 400
+
+
+def check_batch_conflicts(schedules):
+    """Raise BatchError for rows of ``schedules`` that overlap an existing
+    schedule, or an earlier row, on the same line.
+
+    Call with ``occupancy.lock`` held.
+    """
+    errors = []
+    pending = []
+    try:
+        for number, (line_id, start_minute, end_minute, repeat_days) in enumerate(
+            schedules, start=1
+        ):
+            days = mask_to_days(repeat_days)
+            if occupancy.conflicts(line_id, start_minute, end_minute, days):
+                errors.append((number, "Schedule conflicts with an existing schedule."))
+                continue
+            # Later rows are checked against this one too
+            pending.append(("import", number))
+            occupancy.add(pending[-1], line_id, start_minute, end_minute, days)
+    finally:
+        for key in pending:
+            occupancy.remove(key)
+    if errors:
+        raise bulk.BatchError(errors)
+
+
+@in_controller
+def add_schedules(rows):
+    """Add the schedules in bulk import ``rows``, or none of them. Returns
+    how many were added.
+
+    The whole batch is checked for conflicts in memory, written in one
+    transaction and loaded with a single scheduler reload.
+    """
+    with occupancy.lock:
+        with SQLite() as db:
+            lines = db.execute("SELECT id, name FROM watering_lines").fetchall()
+            schedules = bulk.parse_schedules(
+                rows, {line["name"]: line["id"] for line in lines}
+            )
+            check_batch_conflicts(schedules)
+            db.executemany(
+                """
+                INSERT INTO watering_schedule
+                    (watering_line_id, start_minute, end_minute, repeat_days)
+                VALUES (?, ?, ?, ?)
+                """,
+                schedules,
+            )
+        page_cache.invalidate()
+        load_occupancy()
+    load_schedules()
+    return len(schedules)
+
+
+def export_response(query, record, fields, name):
+    """Stream the rows of ``query`` as ?format=json (default) or csv.
+
+    ``query`` takes the last id sent and a row limit, and its rows are
+    fetched ``EXPORT_CHUNK`` at a time, so a slow download doesn't keep a
+    pooled connection from other requests.
+    """
+    format = "csv" if request.args.get("format") == "csv" else "json"
+
+    def chunks():
+        after = 0
+        while True:
+            with SQLite() as db:
+                rows = db.execute(query, (after, bulk.EXPORT_CHUNK)).fetchall()
+            if not rows:
+                return
+            yield rows
+            after = rows[-1]["id"]
+
+    return Response(
+        bulk.stream_records(chunks(), record, fields, format),
+        mimetype="text/csv" if format == "csv" else "application/json",
+        headers={"Content-Disposition": f"attachment; filename={name}.{format}"},
+    )
+
+
+@app.get("/api/lines/export")
+def export_lines():
+    return export_response(
+        """
+        SELECT id, name, gpio_pin, flow, crop_coefficient, node_id FROM watering_lines
+        WHERE id > ? ORDER BY id LIMIT ?
         """,
-            (schedule_id, watering_line_id, end_time, start_time, repeat_days),
-        ).fetchall()
+        bulk.line_record,
+        bulk.LINE_FIELDS,
+        "watering_lines",
+    )
 
-        if existing:
-            return "Schedule conflicts with an existing schedule.", 400
 
-        # Update the schedule
-        db.execute(
-            """
-        UPDATE watering_schedule
-        SET watering_line_id = ?, start_time = ?, end_time = ?, repeat_days = ?
-        WHERE id = ?
+@app.post("/api/lines/import")
+def import_lines():
+    """Add every line in a JSON list or CSV body, or none of them."""
+    try:
+        rows = bulk.read_rows(request)
+        with SQLite() as db:
+            used_pins = [
+                (row["node_id"], row["gpio_pin"])
+                for row in db.execute("SELECT node_id, gpio_pin FROM watering_lines")
+            ]
+            node_ids = {row["id"] for row in db.execute("SELECT id FROM controller_nodes")}
+            lines = bulk.parse_lines(rows, used_pins, node_ids)
+            db.executemany(
+                """
+                INSERT INTO watering_lines (name, gpio_pin, flow, crop_coefficient, node_id)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                lines,
+            )
+    except bulk.BatchError as e:
+        return batch_error(e)
+    lines_changed()
+    return jsonify(imported=len(lines)), 201
+
+
+@app.get("/api/schedules/export")
+def export_schedules():
+    return export_response(
+        """
+        SELECT ws.id, ws.watering_line_id, wl.name AS line, ws.start_minute,
+            ws.end_minute, ws.repeat_days
+        FROM watering_schedule ws
+        INNER JOIN watering_lines wl ON ws.watering_line_id = wl.id
+        WHERE ws.id > ? ORDER BY ws.id LIMIT ?
         """,
-            (watering_line_id, start_time, end_time, repeat_days, schedule_id),
-        )
+        bulk.schedule_record,
+        bulk.SCHEDULE_FIELDS,
+        "watering_schedule",
+    )
 
-    reload_schedules()  # Reload schedules to reflect the change
-    return redirect(url_for("list_schedules"))
 
+@app.post("/api/schedules/import")
+def import_schedules():
+    """Add every schedule in a JSON list or CSV body, or none of them."""
+    try:
+        imported = add_schedules(bulk.read_rows(request))
+    except bulk.BatchError as e:
+        return batch_error(e)
+    return jsonify(imported=imported), 201
 
-@app.route("/schedules/delete/<int:schedule_id>")
-def delete_schedule(schedule_id):
-    """Delete a watering schedule."""
+
+def line_ids_by_name():
     with SQLite() as db:
-        db.execute("DELETE FROM watering_schedule WHERE id = ?", (schedule_id,))
-    reload_schedules()  # Reload schedules to reflect the change
-    return redirect(url_for("list_schedules"))
+        lines = db.execute("SELECT id, name FROM watering_lines").fetchall()
+    return {line["name"]: line["id"] for line in lines}
+
+
+@in_controller
+def add_moisture_rows(rows):
+    """Add the readings in ``rows``, returns how many there were."""
+    readings = parse_readings(rows, line_ids_by_name(), scheduler.now())
+    soil_moisture.add(readings)
+    return len(readings)
+
+
+@in_controller
+def moisture_levels_by_line():
+    return {str(line_id): line for line_id, line in soil_moisture.snapshot().items()}
+
+
+@app.post("/api/moisture")
+def add_moisture_readings():
+    """Take a batch of soil moisture readings, as a JSON list or CSV body
+    with ``watering_line_id`` or ``line``, ``value`` and an optional ``at``."""
+    try:
+        accepted = add_moisture_rows(bulk.read_rows(request))
+    except bulk.BatchError as e:
+        return batch_error(e)
+    return jsonify(accepted=accepted)
+
+
+@app.get("/api/moisture")
+def moisture_levels():
+    """Each line's rolling soil moisture average and latest reading."""
+    values = current_settings()
+    return jsonify(
+        lines=moisture_levels_by_line(),
+        shorten=values["moisture_shorten"],
+        skip=values["moisture_skip"],
+    )
 
 
 @app.route("/lines/")
+@cached_page
 def list_lines():
     with SQLite() as db:
-        water_lines = db.execute("SELECT * FROM watering_lines").fetchall()
-    return render_template("list_lines.html", watering_lines=water_lines)
+        water_lines = db.execute(
+            """
+            SELECT wl.*, cn.name AS node
+            FROM watering_lines wl
+            LEFT JOIN controller_nodes cn ON cn.id = wl.node_id
+            """
+        ).fetchall()
+    values = current_settings()
+    return render_template(
+        "list_lines.html",
+        watering_lines=water_lines,
+        supply_capacity=values["supply_capacity"],
+        moisture_shorten=values["moisture_shorten"],
+        moisture_skip=values["moisture_skip"],
+        reference_et=values["reference_et"],
+    )
+
+
+def parse_flow(text):
+    """A positive whole number from a form field, or None."""
+    try:
+        value = int(text)
+    except ValueError:
+        return None
+    return value if value > 0 else None
+
+
+def parse_coefficient(text):
+    """A crop coefficient from a form field, or None."""
+    try:
+        value = float(text)
+    except ValueError:
+        return None
+    return value if 0 < value <= bulk.MAX_CROP_COEFFICIENT else None
+
+
+def controller_nodes():
+    with SQLite() as db:
+        return db.execute("SELECT id, name, url FROM controller_nodes ORDER BY name").fetchall()
+
+
+def parse_node(text):
+    """``(ok, node_id)`` from a form field, node_id None for this controller."""
+    if not text:
+        return True, None
+    try:
+        node_id = int(text)
+    except ValueError:
+        return False, None
+    return any(node["id"] == node_id for node in controller_nodes()), node_id
+
+
+@app.post("/lines/capacity")
+def set_supply_capacity():
+    capacity = parse_flow(request.form["supply_capacity"])
+    if capacity is None:
+        return "Invalid supply capacity. It must be a positive integer", 400
+    # Queued runs start straight away if the supply grew
+    change_setting("supply_capacity", capacity)
+    return redirect(url_for("list_lines"))
+
+
+@app.post("/lines/moisture")
+def set_moisture_thresholds():
+    thresholds = {}
+    for key in ("moisture_shorten", "moisture_skip"):
+        try:
+            thresholds[key] = int(request.form[key])
+        except ValueError:
+            thresholds[key] = -1
+        if not 0 <= thresholds[key] <= 100:
+            return "Invalid moisture threshold. It must be a percentage, 0 for off", 400
+    for key, percent in thresholds.items():
+        change_setting(key, percent)
+    return redirect(url_for("list_lines"))
+
+
+@app.post("/lines/weather")
+def set_reference_et():
+    try:
+        reference_et = float(request.form["reference_et"])
+    except ValueError:
+        reference_et = 0
+    if reference_et <= 0:
+        return "Invalid reference ET. It must be a positive number of mm per day", 400
+    # Today's run lengths are worked out again
+    change_setting("reference_et", reference_et)
+    return redirect(url_for("list_lines"))
+
+
+@in_controller
+def lines_changed():
+    """Pick up lines added to the database."""
+    page_cache.invalidate()
+    load_lines()
+
+
+@in_controller
+def line_changed(line_id):
+    """Pick up an edited line."""
+    page_cache.invalidate()
+    load_line_schedules(line_id)  # Pick up the new pin, name, flow and coefficient
+    load_lines()
+
+
+@in_controller
+def line_deleted(line_id):
+    """Forget a line deleted from the database."""
+    page_cache.invalidate()
+    occupancy.remove_line(line_id)
+    load_line_schedules(line_id)  # Its schedules no longer fire
+    load_lines()
+    soil_moisture.forget(line_id)
 
 
 @app.route("/lines/delete/<int:line_id>")
@@ -249,6 +1037,7 @@ def delete_line(line_id):
         with SQLite() as db:
             db.execute("DELETE FROM watering_lines WHERE id = ?", (line_id,))
         logging.info(f"Deleted watering line with ID: {line_id}")
+        line_deleted(line_id)
     except Exception as e:
         logging.error(f"Failed to delete watering line: {e}")
         return "An error occurred.", 500
@@ -260,7 +1049,7 @@ def delete_line(line_id):
 @app.route("/lines/create", methods=["GET", "POST"])
 def create_line():
     if request.method == "GET":
-        return render_template("create_line.html")
+        return render_template("create_line.html", nodes=controller_nodes())
 
     # Get data from the form
     name = request.form["name"].strip()
@@ -272,18 +1061,34 @@ def create_line():
     if not name:
         return "Name is required", 400
 
+    flow = parse_flow(request.form.get("flow", "1"))
+    if flow is None:
+        return "Invalid flow. It must be a positive integer", 400
+    crop_coefficient = parse_coefficient(request.form.get("crop_coefficient", "1"))
+    if crop_coefficient is None:
+        return "Invalid crop coefficient. It must be above 0 and at most 3", 400
+    valid_node, node_id = parse_node(request.form.get("node_id"))
+    if not valid_node:
+        return "Unknown controller node", 400
+
     # Insert the new watering line into the database
     with SQLite() as db:
+        # Pins are per controller
         existing_pin = db.execute(
-            "SELECT id FROM watering_lines WHERE gpio_pin = ?", (gpio_pin,)
+            "SELECT id FROM watering_lines WHERE gpio_pin = ? AND node_id IS ?",
+            (gpio_pin, node_id),
         ).fetchone()
         if existing_pin:
             return "GPIO Pin is already in use.", 400
 
         db.execute(
-            "INSERT INTO watering_lines (name, gpio_pin) VALUES (?, ?)",
-            (name, gpio_pin),
+            """
+            INSERT INTO watering_lines (name, gpio_pin, flow, crop_coefficient, node_id)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (name, gpio_pin, flow, crop_coefficient, node_id),
         )
+    lines_changed()
     # Redirect to a page listing watering lines
     return redirect(url_for("list_lines"))
 
@@ -296,14 +1101,28 @@ def edit_line_post(line_id):
         gpio_pin = int(request.form["gpio_pin"])
     except ValueError:
         return "Invalid GPIO Pin. It must be an integer", 400
+    flow = parse_flow(request.form.get("flow", "1"))
+    if flow is None:
+        return "Invalid flow. It must be a positive integer", 400
+    crop_coefficient = parse_coefficient(request.form.get("crop_coefficient", "1"))
+    if crop_coefficient is None:
+        return "Invalid crop coefficient. It must be above 0 and at most 3", 400
+    valid_node, node_id = parse_node(request.form.get("node_id"))
+    if not valid_node:
+        return "Unknown controller node", 400
     test = dict(request.form)
     test["line_id"] = line_id
     with SQLite() as db:
         # Update the watering line in the database
         db.execute(
-            "UPDATE watering_lines SET name = ?, gpio_pin = ? WHERE id = ?",
-            (name, gpio_pin, line_id),
+            """
+            UPDATE watering_lines
+            SET name = ?, gpio_pin = ?, flow = ?, crop_coefficient = ?, node_id = ?
+            WHERE id = ?
+            """,
+            (name, gpio_pin, flow, crop_coefficient, node_id, line_id),
         )
+    line_changed(line_id)
 
     # Redirect to the list page
     return redirect(url_for("list_lines"))
@@ -322,17 +1141,54 @@ def edit_line(line_id):
         return "Watering line not found", 404
 
     # Pass the current details to the edit form
-    return render_template("edit_line.html", line=line)
+    return render_template("edit_line.html", line=line, nodes=controller_nodes())
+
+
+# Longest span the history page shows, well past any install's age
+MAX_HISTORY_DAYS = 3660
+
+
+@app.get("/history")
+def watering_history():
+    """Runs, minutes watered and skipped runs per line, from the rollups."""
+    days = min(max(1, request.args.get("days", 14, type=int)), MAX_HISTORY_DAYS)
+    since = (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+    with SQLite() as db:
+        daily = db.execute(
+            """
+            SELECT d.day, COALESCE(wl.name, 'Line ' || d.watering_line_id) AS name,
+                d.runs, d.minutes, d.skipped
+            FROM watering_daily d
+            LEFT JOIN watering_lines wl ON wl.id = d.watering_line_id
+            WHERE d.day >= ?
+            ORDER BY d.day DESC, name
+            """,
+            (since,),
+        ).fetchall()
+        totals = db.execute(
+            """
+            SELECT COALESCE(wl.name, 'Line ' || d.watering_line_id) AS name,
+                SUM(d.runs) AS runs, SUM(d.minutes) AS minutes, SUM(d.skipped) AS skipped
+            FROM watering_daily d
+            LEFT JOIN watering_lines wl ON wl.id = d.watering_line_id
+            WHERE d.day >= ?
+            GROUP BY d.watering_line_id
+            ORDER BY name
+            """,
+            (since,),
+        ).fetchall()
+    return render_template("history.html", days=days, daily=daily, totals=totals)
 
 
 @app.route("/maintenance", methods=["GET", "POST"])
 def maintenance():
     """Page to test and toggle watering lines."""
     with SQLite() as db:
-        watering_lines = db.execute("SELECT * FROM watering_lines").fetchall()
-        mode = db.execute(
-            "SELECT value FROM settings WHERE key = 'maintenance_mode'"
-        ).fetchone()["value"]
+        # Lines on other controllers are switched from their own page
+        watering_lines = db.execute(
+            "SELECT * FROM watering_lines WHERE node_id IS NULL"
+        ).fetchall()
+    mode = "on" if maintenance_check() else "off"
     if request.method == "POST":
         # Handle toggling
         line_id = int(request.form["line_id"])
@@ -345,44 +1201,306 @@ def maintenance():
         if line:
             gpio_pin = line["gpio_pin"]
 
-            if action == "on":
-                activate_line(gpio_pin)  # Turn the line on
-            elif action == "off":
-                deactivate_line(gpio_pin)  # Turn the line off
+            if action in ("on", "off"):
+                switch_line(gpio_pin, action == "on")
+
+    return render_template(
+        "maintenance.html",
+        watering_lines=watering_lines,
+        mode=mode,
+        pin_states=dict(pin_states()),
+    )
+
+
+@in_controller
+def switch_line(gpio_pin, on):
+    if on:
+        actuator.activate_line(gpio_pin)  # Turn the line on
+    else:
+        actuator.deactivate_line(gpio_pin)  # Turn the line off
 
-    return render_template("maintenance.html", watering_lines=watering_lines, mode=mode)
+
+@in_controller
+def pin_states():
+    """``[(pin, active), ...]``, as JSON objects can't have integer keys."""
+    return sorted(pin_controller.get_pin_states().items())
 
 
 @app.route("/maintenance/toggle_maintenance", methods=["POST"])
 def toggle_maintenance():
-    with SQLite() as db:
-        mode = db.execute(
-            "SELECT value FROM settings WHERE key = 'maintenance_mode'"
-        ).fetchone()["value"]
-        new_mode = "on" if mode == "off" else "off"
-        db.execute(
-            "UPDATE settings SET value = ? WHERE key = 'maintenance_mode'", (
-                new_mode,)
-        )
-    deactivate_all_lines()
+    # Subscribers switch every line off
+    toggle_setting("maintenance_mode")
     return redirect(url_for("maintenance"))
 
 
-def maintenance_check():
+# Seconds between keepalive comments, which also notice closed connections
+EVENT_HEARTBEAT = 15
+
+# Open /events streams per web worker, fewer than its threads so pages
+# are still served with every one open. gunicorn.conf.py sets it from the
+# worker's thread count.
+worker_streams = threading.BoundedSemaphore(4)
+
+
+def live_state():
+    """Everything a new /events client needs before the first change."""
+    next_run = scheduler.next_run()
+    return {
+        "maintenance_mode": maintenance_check(),
+        "pins": pin_controller.get_pin_states(),
+        "schedules": len(scheduler.tags()),
+        "next_run": next_run.isoformat() if next_run else None,
+    }
+
+
+@in_controller
+def live_events():
+    """The messages of one /events stream, starting with the current state.
+    Ends straight away if there are too many live clients."""
+    subscription = event_bus.subscribe()
+    if subscription is None:
+        return
+    try:
+        yield format_event("state", live_state())
+        while not subscription.closed:
+            message = subscription.get(EVENT_HEARTBEAT)
+            yield message if message else ": keepalive\n\n"
+    finally:
+        event_bus.unsubscribe(subscription)
+
+
+@app.get("/events")
+def events_stream():
+    """Valve, maintenance and schedule changes as Server-Sent Events."""
+    if WEB_WORKER and not worker_streams.acquire(blocking=False):
+        return "Too many live clients", 503
+    try:
+        messages = live_events()
+        state = next(messages, None)
+    except Exception:
+        if WEB_WORKER:
+            worker_streams.release()
+        raise
+    if state is None:
+        if WEB_WORKER:
+            worker_streams.release()
+        return "Too many live clients", 503
+
+    def stream():
+        try:
+            yield state
+            yield from messages
+        finally:
+            messages.close()
+            if WEB_WORKER:
+                worker_streams.release()
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@in_controller
+def node_state():
+    """What the coordinator collects from this controller."""
+    _, lines = status.lines()
+    return {
+        "maintenance_mode": maintenance_check(),
+        "pins": pin_controller.get_pin_states(),
+        "dispatcher": dispatcher.status(),
+        "lines": [line.to_dict() for line in lines],
+        "line_count": len(lines),
+        "schedule_count": len(scheduler.tags()),
+    }
+
+
+@in_controller
+def apply_node_sync(payload):
+    with occupancy.lock:
+        with SQLite() as db:
+            applied = federation.apply_sync(db, payload)
+        page_cache.invalidate()
+        load_occupancy()
+    load_lines()
+    load_schedules()
+    return applied
+
+
+@app.post("/api/node/sync")
+def node_sync():
+    """Apply lines and schedules pushed by a coordinator."""
+    if not federation.authorized(request):
+        return jsonify(error="Wrong or missing node token"), 403
+    try:
+        applied = apply_node_sync(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(applied=applied, state=node_state())
+
+
+@app.get("/api/node/state")
+def node_state_json():
+    if not federation.authorized(request):
+        return jsonify(error="Wrong or missing node token"), 403
+    return jsonify(node_state())
+
+
+@in_controller
+def node_list():
+    return coordinator.nodes()
+
+
+@in_controller
+def nodes_changed():
+    coordinator.load_nodes()
+
+
+@app.get("/nodes")
+def list_nodes():
+    """Controller nodes and what they last reported."""
     with SQLite() as db:
-        maintenance = db.execute(
-            "SELECT value FROM settings WHERE key = 'maintenance_mode'"
-        ).fetchone()["value"]
-    return maintenance == "on"
+        line_counts = {
+            row["node_id"]: row["lines"]
+            for row in db.execute(
+                "SELECT node_id, COUNT(*) AS lines FROM watering_lines GROUP BY node_id"
+            )
+        }
+    return render_template(
+        "nodes.html", nodes=node_list(), line_counts=line_counts
+    )
 
 
-if __name__ == "__main__":
+@app.post("/nodes/create")
+def create_node():
+    name = request.form["name"].strip()
+    url = request.form["url"].strip()
+    if not name:
+        return "Name is required", 400
+    try:
+        federation.NodeClient(url)
+    except ValueError:
+        return "Invalid URL. It must look like http://192.168.1.20:5000", 400
+    with SQLite() as db:
+        if db.execute("SELECT id FROM controller_nodes WHERE name = ?", (name,)).fetchone():
+            return "A node with that name already exists.", 400
+        db.execute("INSERT INTO controller_nodes (name, url) VALUES (?, ?)", (name, url))
+    nodes_changed()
+    return redirect(url_for("list_nodes"))
+
+
+@app.route("/nodes/delete/<int:node_id>")
+def delete_node(node_id):
+    with SQLite() as db:
+        if db.execute(
+            "SELECT id FROM watering_lines WHERE node_id = ?", (node_id,)
+        ).fetchone():
+            return "Move or delete the node's watering lines first.", 400
+        db.execute("DELETE FROM controller_nodes WHERE id = ?", (node_id,))
+    nodes_changed()
+    return redirect(url_for("list_nodes"))
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint."""
+    if WEB_WORKER:
+        # Request metrics are this worker's own
+        text = controller_metrics() + metrics.render(include=WORKER_METRICS)
+    else:
+        text = metrics.render()
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
+@in_controller
+def controller_metrics():
+    return metrics.render(exclude=WORKER_METRICS)
+
+
+@in_controller
+def maintenance_check():
+    return settings.get("maintenance_mode")
+
+
+@in_controller
+def current_settings():
+    return {key: settings.get(key) for key in DEFAULTS}
+
+
+@in_controller
+def change_setting(key, value):
+    settings.set(key, value)
+
+
+@in_controller
+def toggle_setting(key):
+    return settings.toggle(key)
+
+
+def start():
+    """Open the database and start the scheduler and the workers around it."""
+    # Create the database or upgrade it to the current schema
+    migrate()
+    history.start()
+    soil_moisture.start()
+    # A file or named pipe of JSON readings, e.g. for testing without sensors
+    if os.environ.get("WATERING_MOISTURE_SOURCE"):
+        FileSource(
+            os.environ["WATERING_MOISTURE_SOURCE"], soil_moisture, line_ids_by_name
+        ).start()
+    settings.load()
+    dispatcher.set_capacity(settings.get("supply_capacity"))
+    weather.set_reference_et(settings.get("reference_et"))
+
     # initlise all pins as outputs in a inactive state.
-    enable_all_lines()
+    pin_controller.set_polarity(settings.get("watering_when_GPIO_high"))
+    pin_controller.enable_all_lines()
+    actuator.start()
+
+    # Index existing schedules for conflict checks
+    load_occupancy()
 
     # Start the scheduler on a background thread
+    load_lines()
     load_schedules()
-    threading.Thread(target=run_schedule, daemon=True).start()
+    scheduler.start()
+
+    # Push the lines bound to other controllers to them
+    coordinator.load_nodes()
+    coordinator.start()
 
-    # start webserver
-    app.run(debug=False, host="0.0.0.0")
+    startup = time.perf_counter() - STARTUP_BEGAN
+    STARTUP.observe(startup)
+    logger.info(f"Ready to serve after {startup:.2f}s")
+
+
+def stop():
+    """Stop the scheduler, close the valves and write out the history and
+    soil moisture still held in memory."""
+    coordinator.stop()
+    scheduler.stop()
+    # Nothing would stop a run left open, the next start() reconciles
+    dispatcher.clear()
+    actuator.deactivate_all_lines()
+    actuator.stop()
+    history.stop()
+    soil_moisture.stop()
+    logger.info("Stopped")
+
+
+def exit_on_sigterm():
+    """Unwind like on Ctrl-C when systemd or a supervisor sends SIGTERM,
+    which skips ``finally`` blocks and atexit otherwise."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+if __name__ == "__main__":
+    exit_on_sigterm()
+    start()
+    try:
+        # start webserver
+        # WATERING_PORT lets several controllers run side by side for testing
+        app.run(debug=False, host="0.0.0.0", port=int(os.environ.get("WATERING_PORT", 5000)))
+    finally:
+        stop()
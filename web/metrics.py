@@ -0,0 +1,216 @@
+"""In-process metrics rendered in the Prometheus text format.
+
+Every thread updates its own shard of each metric, so recording a value
+never waits on a lock. Shards are only merged when ``render()`` is called
+for a scrape. Shards of finished threads are folded into one total
+whenever a new thread takes a shard, so the per-request threads of the
+Flask server don't pile up even if nothing scrapes.
+"""
+
+import bisect
+import threading
+import time
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Sharded:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                # Fold finished threads in now too, so an install nobody
+                # scrapes keeps a shard per live thread, not per request
+                self._retire()
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def _retire(self):
+        # Called with the lock held
+        live = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                live.append((thread, values))
+            else:
+                self._merge(self._retired, values.copy())
+        self._shards = live
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _merge(self, into, values):
+        raise NotImplementedError
+
+    def collect(self):
+        """Merged ``{label values: value}`` across every thread."""
+        with self._lock:
+            self._retire()
+            merged = {}
+            self._merge(merged, self._retired)
+            for _, values in self._shards:
+                # A dict copy is atomic under the GIL, so this is safe while
+                # the owning thread keeps adding to it
+                self._merge(merged, values.copy())
+        return merged
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        values = self._shard()
+        key = self._key(labels)
+        values[key] = values.get(key, 0) + amount
+
+    def _merge(self, into, values):
+        for key, value in values.items():
+            into[key] = into.get(key, 0) + value
+
+    def render(self):
+        lines = self._header()
+        for key, value in sorted(self.collect().items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, key)} "
+                f"{_format_value(value)}"
+            )
+        return lines
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        values = self._shard()
+        key = self._key(labels)
+        counts = values.get(key)
+        if counts is None:
+            # One slot per bucket plus +Inf, then the running sum
+            counts = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _merge(self, into, values):
+        for key, counts in values.items():
+            total = into.get(key)
+            if total is None:
+                into[key] = list(counts)
+            else:
+                for index, count in enumerate(counts):
+                    total[index] += count
+
+    def render(self):
+        lines = self._header()
+        for key, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames, key, [("le", _format_value(float(bound)))]
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class _Timer:
+    """Context manager observing how long its block took."""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self, include=None, exclude=()):
+        """Text exposition of every metric, or of those named in
+        ``include``, less those named in ``exclude``."""
+        with self._lock:
+            metrics = [
+                metric
+                for name, metric in self._metrics.items()
+                if (include is None or name in include) and name not in exclude
+            ]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+def render(include=None, exclude=()):
+    return REGISTRY.render(include, exclude)
@@ -0,0 +1,350 @@
+"""Soil moisture readings per watering line.
+
+Readings, in percent, arrive in batches over HTTP or from a local file or
+named pipe of JSON lines. Each line keeps its latest ``WINDOW`` readings in
+a ring buffer with a running total, so the rolling average checked before
+every run costs O(1). Readings are also folded into ``BUCKET_MINUTES`` long
+buckets that a worker writes to moisture_readings in one transaction every
+``FLUSH_INTERVAL`` seconds.
+"""
+
+import datetime
+import json
+import logging
+import os
+import stat
+import threading
+import time
+from array import array
+
+import metrics
+from bulk import BatchError
+from utils import DATABASE, SQLite
+
+logger = logging.getLogger(__name__)
+
+# Readings per line in the rolling average
+WINDOW = 12
+# Length of the periods readings are averaged over in the database
+BUCKET_MINUTES = 15
+# A line whose last reading is older than this waters on the clock again
+STALE_AFTER = datetime.timedelta(hours=6)
+
+READINGS = metrics.counter(
+    "watering_moisture_readings_total", "Soil moisture readings accepted, by source.", ("source",)
+)
+MOISTURE_FLUSHES = metrics.histogram(
+    "watering_moisture_flush_seconds", "Time to write one batch of moisture buckets."
+)
+
+
+class RingBuffer:
+    """The last ``size`` values in a fixed array, with their running total."""
+
+    def __init__(self, size=WINDOW):
+        self.values = array("d", bytes(8 * size))
+        self.count = 0
+        self.total = 0.0
+        self._next = 0
+
+    def push(self, value):
+        if self.count == len(self.values):
+            self.total -= self.values[self._next]
+        else:
+            self.count += 1
+        self.values[self._next] = value
+        self.total += value
+        self._next = (self._next + 1) % len(self.values)
+        if self._next == 0:
+            # Once per lap, so rounding errors in the running total can't build up
+            self.total = sum(self.values[: self.count])
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def latest(self):
+        return self.values[self._next - 1] if self.count else None
+
+
+def bucket_start(at):
+    """Start of the ``BUCKET_MINUTES`` period containing ``at``."""
+    return at.replace(
+        minute=at.minute - at.minute % BUCKET_MINUTES, second=0, microsecond=0
+    )
+
+
+def parse_readings(rows, line_ids_by_name, now):
+    """``(watering_line_id, value, at)`` for each row.
+
+    Rows name their line by ``watering_line_id`` or by ``line``, ``value``
+    is a percentage and ``at`` an optional ISO 8601 time, ``now`` if missing.
+    """
+    readings = []
+    errors = []
+    line_ids = set(line_ids_by_name.values())
+    for number, row in enumerate(rows, start=1):
+        try:
+            if row.get("watering_line_id") not in (None, ""):
+                line_id = row["watering_line_id"]
+                try:
+                    if isinstance(line_id, bool) or not isinstance(line_id, (int, str)):
+                        raise ValueError
+                    line_id = int(line_id)
+                except ValueError:
+                    raise ValueError("watering_line_id must be an integer")
+                if line_id not in line_ids:
+                    raise ValueError(f"no watering line with id {line_id}")
+            elif isinstance(row.get("line"), str) and row["line"] in line_ids_by_name:
+                line_id = line_ids_by_name[row["line"]]
+            else:
+                raise ValueError(f"no watering line named {row.get('line')!r}")
+            value = row.get("value")
+            try:
+                if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+                    raise ValueError
+                value = float(value)
+            except ValueError:
+                raise ValueError("value must be a number")
+            if not 0 <= value <= 100:
+                raise ValueError("value must be a percentage between 0 and 100")
+            at = now
+            if row.get("at"):
+                try:
+                    if not isinstance(row["at"], str):
+                        raise ValueError
+                    at = datetime.datetime.fromisoformat(row["at"])
+                except ValueError:
+                    raise ValueError("at must be an ISO 8601 time")
+                if at.tzinfo is not None:
+                    # Schedules run on the Pi's local time
+                    at = at.astimezone().replace(tzinfo=None)
+        except ValueError as e:
+            errors.append((number, str(e)))
+            continue
+        readings.append((line_id, value, at))
+    if errors:
+        raise BatchError(errors)
+    return readings
+
+
+def adjusted_minutes(average, minutes, shorten_at, skip_at):
+    """How long to water given the soil's average moisture, 0 to skip.
+
+    At ``skip_at`` percent or wetter the run is skipped. From ``shorten_at``
+    it shrinks in proportion to how close the soil is to ``skip_at``, to at
+    least a minute. A threshold of 0 is switched off.
+    """
+    if average is None:
+        return minutes
+    if skip_at and average >= skip_at:
+        return 0
+    if not shorten_at or average < shorten_at or minutes is None:
+        return minutes
+    if skip_at > shorten_at:
+        scale = (skip_at - average) / (skip_at - shorten_at)
+    else:
+        scale = 0.5
+    return max(1, round(minutes * scale))
+
+
+class MoistureStore:
+    """Rolling soil moisture per watering line, persisted in batches.
+
+    ``add()`` only updates memory. While the worker is running, each
+    reading is also counted into its line's bucket and the buckets touched
+    since the last flush are upserted together, so partial buckets written
+    by separate flushes add up.
+    """
+
+    FLUSH_INTERVAL = 60.0
+
+    def __init__(self, file=DATABASE, window=WINDOW):
+        self.file = file
+        self.window = window
+        self._buffers = {}
+        self._last_at = {}
+        # (line_id, bucket) -> [samples, total, low, high] not yet written
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def add(self, readings, source="http"):
+        with self._lock:
+            for line_id, value, at in readings:
+                buffer = self._buffers.get(line_id)
+                if buffer is None:
+                    buffer = self._buffers[line_id] = RingBuffer(self.window)
+                buffer.push(value)
+                if line_id not in self._last_at or at > self._last_at[line_id]:
+                    self._last_at[line_id] = at
+                if self._thread is None:
+                    continue
+                key = (line_id, bucket_start(at).isoformat(timespec="minutes"))
+                bucket = self._pending.get(key)
+                if bucket is None:
+                    self._pending[key] = [1, value, value, value]
+                else:
+                    bucket[0] += 1
+                    bucket[1] += value
+                    bucket[2] = min(bucket[2], value)
+                    bucket[3] = max(bucket[3], value)
+        READINGS.inc(len(readings), source=source)
+
+    def average(self, line_id, now):
+        """Rolling average of ``line_id``, None without a recent reading."""
+        with self._lock:
+            buffer = self._buffers.get(line_id)
+            if buffer is None or now - self._last_at[line_id] > STALE_AFTER:
+                return None
+            return buffer.mean()
+
+    def snapshot(self):
+        """``{line_id: {...}}`` of every line that has readings."""
+        with self._lock:
+            return {
+                line_id: {
+                    "average": buffer.mean(),
+                    "latest": buffer.latest(),
+                    "samples": buffer.count,
+                    "at": self._last_at[line_id].isoformat(timespec="seconds"),
+                }
+                for line_id, buffer in self._buffers.items()
+            }
+
+    def forget(self, line_id):
+        with self._lock:
+            self._buffers.pop(line_id, None)
+            self._last_at.pop(line_id, None)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            with MOISTURE_FLUSHES.time(), SQLite(self.file) as db:
+                db.executemany(
+                    """
+                    INSERT INTO moisture_readings
+                        (watering_line_id, bucket, samples, total, low, high)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (watering_line_id, bucket) DO UPDATE SET
+                        samples = samples + excluded.samples,
+                        total = total + excluded.total,
+                        low = MIN(low, excluded.low),
+                        high = MAX(high, excluded.high)
+                    """,
+                    [(*key, *bucket) for key, bucket in pending.items()],
+                )
+        except Exception:
+            logger.exception(f"Failed to write {len(pending)} moisture buckets")
+
+    def run(self):
+        while not self._stopping.wait(self.FLUSH_INTERVAL):
+            self.flush()
+        self.flush()
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write the pending buckets, then stop the worker."""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+
+class FileSource:
+    """Feeds readings from a file or named pipe of JSON lines to a store.
+
+    Each line is an object like an HTTP reading, e.g.
+    ``{"line": "Ferns", "value": 42.5}``. A regular file is followed like
+    ``tail -f``, a pipe is reopened whenever its writer closes it. Lines
+    read together are added as one batch, bad ones are logged and skipped.
+    """
+
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, path, store, line_ids_by_name, now=datetime.datetime.now):
+        self.path = path
+        self.store = store
+        # Called for each batch, so lines added later are recognised
+        self.line_ids_by_name = line_ids_by_name
+        self.now = now
+        # (inode, offset) just past the last line handed to the store, to
+        # carry on from when a regular file is reopened after an error
+        self._position = None
+        self._thread = None
+
+    def read(self, lines):
+        """Add the readings in ``lines`` to the store."""
+        readings = []
+        line_ids = self.line_ids_by_name()
+        for text in lines:
+            if not text.strip():
+                continue
+            try:
+                readings += parse_readings([json.loads(text)], line_ids, self.now())
+            except BatchError as e:
+                logger.warning(f"Skipped moisture reading {text.strip()!r}: {e.errors[0][1]}")
+            except (ValueError, AttributeError):
+                logger.warning(f"Skipped moisture reading {text.strip()!r}: not a JSON object")
+            except Exception:
+                # Never let one line stop the reader
+                logger.exception(f"Skipped moisture reading {text.strip()!r}")
+        if readings:
+            try:
+                self.store.add(readings, source="file")
+            except Exception:
+                logger.exception(f"Dropped {len(readings)} moisture readings from {self.path}")
+
+    def _follow(self, file):
+        info = os.fstat(file.fileno())
+        pipe = stat.S_ISFIFO(info.st_mode)
+        if not pipe and self._position is not None:
+            inode, offset = self._position
+            # Unless the file was replaced or truncated since
+            if inode == info.st_ino and offset <= info.st_size:
+                file.seek(offset)
+        batch = []
+        partial = b""
+        while True:
+            data = file.readline()
+            if data.endswith(b"\n"):
+                batch.append((partial + data).decode(errors="replace"))
+                partial = b""
+                continue
+            # End of what has been written so far, maybe half way through a line
+            partial += data
+            if batch:
+                self.read(batch)
+                batch = []
+                if not pipe:
+                    self._position = (info.st_ino, file.tell() - len(partial))
+            if pipe and not data:
+                # The writer closed the pipe
+                return
+            time.sleep(self.POLL_INTERVAL)
+
+    def run(self):
+        while True:
+            try:
+                with open(self.path, "rb") as file:
+                    self._follow(file)
+            except OSError as e:
+                logger.warning(f"Can't read moisture source {self.path}: {e}")
+                time.sleep(self.POLL_INTERVAL)
+            except Exception:
+                # Anything else, so the reader thread never dies
+                logger.exception(f"Moisture source {self.path} failed, reopening it")
+                time.sleep(self.POLL_INTERVAL)
+
+    def start(self):
+        logger.info(f"Reading soil moisture from {self.path}")
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
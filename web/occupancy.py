@@ -0,0 +1,151 @@
+import threading
+
+from scheduler import MINUTES_PER_DAY, MINUTES_PER_WEEK
+
+
+class WeekTree:
+    """Segment tree over the minutes of the week.
+
+    Supports adding to a range of minutes and asking for the highest count
+    in a range, both in O(log n). Each node stores the maximum of its
+    subtree plus the amount added to the whole node, so updates never need
+    to be pushed down to the children. Nodes are only stored once touched,
+    keeping a line with a handful of schedules to a few hundred entries.
+    """
+
+    def __init__(self, size=MINUTES_PER_WEEK):
+        self.size = size
+        self._max = {}
+        self._add = {}
+
+    def add(self, start, end, amount):
+        """Add ``amount`` to every minute in ``[start, end)``."""
+        if start < end:
+            self._update(1, 0, self.size, start, end, amount)
+
+    def max(self, start, end):
+        """The highest count of any minute in ``[start, end)``."""
+        if start >= end:
+            return 0
+        return self._query(1, 0, self.size, start, end)
+
+    def _update(self, node, lo, hi, start, end, amount):
+        if start <= lo and hi <= end:
+            self._add[node] = self._add.get(node, 0) + amount
+            self._max[node] = self._max.get(node, 0) + amount
+            return
+        mid = (lo + hi) // 2
+        if start < mid:
+            self._update(2 * node, lo, mid, start, end, amount)
+        if end > mid:
+            self._update(2 * node + 1, mid, hi, start, end, amount)
+        self._max[node] = self._add.get(node, 0) + max(
+            self._max.get(2 * node, 0), self._max.get(2 * node + 1, 0)
+        )
+
+    def _query(self, node, lo, hi, start, end):
+        if start <= lo and hi <= end:
+            return self._max.get(node, 0)
+        mid = (lo + hi) // 2
+        best = None
+        if start < mid:
+            best = self._query(2 * node, lo, mid, start, end)
+        if end > mid:
+            right = self._query(2 * node + 1, mid, hi, start, end)
+            best = right if best is None else max(best, right)
+        return self._add.get(node, 0) + best
+
+
+def week_intervals(start_minute, end_minute, days):
+    """Split a daily run into ``[start, end)`` minute-of-week intervals.
+
+    ``days`` are ``datetime.weekday()`` numbers. A run that ends at or before
+    its start time finishes the next day, wrapping from Sunday to Monday.
+    """
+    if end_minute <= start_minute:
+        end_minute += MINUTES_PER_DAY
+    intervals = []
+    for day in days:
+        start = day * MINUTES_PER_DAY + start_minute
+        end = day * MINUTES_PER_DAY + end_minute
+        if end > MINUTES_PER_WEEK:
+            intervals.append((start, MINUTES_PER_WEEK))
+            intervals.append((0, end - MINUTES_PER_WEEK))
+        else:
+            intervals.append((start, end))
+    return intervals
+
+
+class OccupancyIndex:
+    """Which minutes of the week each watering line is already scheduled to
+    water.
+
+    A line waters one run at a time. Runs on different lines may overlap
+    however much flow they draw, the dispatcher queues those that don't fit
+    the supply capacity when they come round.
+    """
+
+    def __init__(self):
+        # Hold while checking for conflicts and writing the schedule so two
+        # requests can't both claim the same slot
+        self.lock = threading.RLock()
+        self._lines = {}
+        self._schedules = {}
+
+    def add(self, schedule_id, line_id, start_minute, end_minute, days):
+        """Record a schedule, replacing any previous entry for its id."""
+        with self.lock:
+            self.remove(schedule_id)
+            entry = (line_id, week_intervals(start_minute, end_minute, days))
+            self._apply(entry, 1)
+            self._schedules[schedule_id] = entry
+
+    def remove(self, schedule_id):
+        with self.lock:
+            entry = self._schedules.pop(schedule_id, None)
+            if entry is not None:
+                self._apply(entry, -1)
+
+    def _apply(self, entry, sign):
+        line_id, intervals = entry
+        line = self._lines.get(line_id)
+        if line is None:
+            line = self._lines[line_id] = WeekTree()
+        for start, end in intervals:
+            line.add(start, end, sign)
+
+    def remove_line(self, line_id):
+        with self.lock:
+            for schedule_id, entry in list(self._schedules.items()):
+                if entry[0] == line_id:
+                    self.remove(schedule_id)
+            self._lines.pop(line_id, None)
+
+    def rebuild(self, schedules):
+        """Replace the index with ``(schedule_id, line_id, start, end, days)``
+        tuples."""
+        with self.lock:
+            self._lines = {}
+            self._schedules = {}
+            for schedule in schedules:
+                self.add(*schedule)
+
+    def conflicts(self, line_id, start_minute, end_minute, days, ignore=None):
+        """True if the run would overlap another run on its line.
+
+        ``ignore`` is the id of a schedule being edited, which may overlap
+        its own previous times.
+        """
+        with self.lock:
+            ignored = self._schedules.get(ignore)
+            if ignored is not None:
+                self._apply(ignored, -1)
+            try:
+                line = self._lines.get(line_id)
+                for start, end in week_intervals(start_minute, end_minute, days):
+                    if line is not None and line.max(start, end) > 0:
+                        return True
+                return False
+            finally:
+                if ignored is not None:
+                    self._apply(ignored, 1)
@@ -0,0 +1,192 @@
+"""Relay pin control with a choice of backend.
+
+WATERING_PIN_CONTROLLER picks the backend:
+
+    gpio    RPi.GPIO on a Raspberry Pi (the default)
+    dummy   in memory only, for running off the Pi
+    file    in memory, with every pin's level also written to the JSON file
+            named by WATERING_PIN_FILE, for watching from another process
+
+The backend is imported only when it is chosen, so nothing off the Pi
+needs RPi.GPIO.
+"""
+
+import json
+import logging
+import os
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Physical (BOARD numbered) pins wired to the 8 relay board
+PINLIST = {11, 12, 13, 15, 16, 18, 22, 24}
+
+GPIO_WRITES = metrics.counter(
+    "watering_gpio_writes_total", "Batched GPIO output calls."
+)
+GPIO_PIN_CHANGES = metrics.counter(
+    "watering_gpio_pin_changes_total", "Pin state changes written.", ("pin",)
+)
+
+
+class GPIOBackend:
+    """RPi.GPIO with physical pin numbering."""
+
+    name = "gpio"
+
+    def __init__(self):
+        import RPi.GPIO as GPIO  # Only importable on a Raspberry Pi
+
+        self.GPIO = GPIO
+        GPIO.setwarnings(False)  # Not sure what these annoying warnings do
+        GPIO.setmode(GPIO.BOARD)  # Use physical pin numbering
+
+    def setup(self, pins, high):
+        self.GPIO.setup(list(pins), self.GPIO.OUT, initial=self._level(high))
+
+    def write(self, pins, levels):
+        self.GPIO.output(list(pins), [self._level(high) for high in levels])
+
+    def _level(self, high):
+        return self.GPIO.HIGH if high else self.GPIO.LOW
+
+
+class MemoryBackend:
+    """Keeps each pin's level in memory, for running without relays."""
+
+    name = "dummy"
+
+    def __init__(self):
+        self.levels = {}
+
+    def setup(self, pins, high):
+        self.write(pins, [high] * len(pins))
+
+    def write(self, pins, levels):
+        self.levels.update(zip(pins, levels))
+
+
+class FileBackend(MemoryBackend):
+    """Like MemoryBackend, and writes ``{pin: "HIGH"|"LOW"}`` to ``path``
+    after every change, replacing the file in one step."""
+
+    name = "file"
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def write(self, pins, levels):
+        super().write(pins, levels)
+        levels = {str(pin): "HIGH" if high else "LOW" for pin, high in self.levels.items()}
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(levels, file, sort_keys=True)
+        os.replace(temporary, self.path)
+
+
+class PinController:
+    """Drives the relay pins through a backend.
+
+    Keeps a shadow register of what was last written to each pin, True
+    while its line is watering, so unchanged pins are never rewritten and
+    the state can be read without touching the hardware. Pins missing from
+    it have not been set up yet.
+    """
+
+    PINLIST = PINLIST
+
+    def __init__(self, backend, watering_when_GPIO_high=False):
+        self.backend = backend
+        # If true, the pin is set high during watering. The 8 relay board is
+        # active low.
+        self.watering_when_GPIO_high = watering_when_GPIO_high
+        self._pin_active = {}
+        self._pin_lock = threading.Lock()
+
+    def _level(self, active):
+        return active == self.watering_when_GPIO_high
+
+    def enable_all_lines(self):
+        """Set up every pin as an output, all switched off, in one call."""
+        with self._pin_lock:
+            self.backend.setup(sorted(self.PINLIST), self._level(False))
+            self._pin_active.update(dict.fromkeys(self.PINLIST, False))
+        logger.debug("Set up pins as outputs", extra={"pins": sorted(self.PINLIST)})
+
+    def deactivate_all_lines(self):
+        self.set_lines(dict.fromkeys(self.PINLIST, False))
+
+    def set_lines(self, states: dict):
+        """Drive each pin in ``{pin: active}`` to its state.
+
+        Only pins whose state differs from the shadow register are written,
+        all in a single backend call. Returns the pins that changed.
+        """
+        with self._pin_lock:
+            changed = [
+                pin for pin, active in states.items() if self._pin_active.get(pin) != active
+            ]
+            if changed:
+                self.backend.write(changed, [self._level(states[pin]) for pin in changed])
+                for pin in changed:
+                    self._pin_active[pin] = states[pin]
+                    GPIO_PIN_CHANGES.inc(pin=pin)
+                GPIO_WRITES.inc()
+        if changed:
+            logger.debug(
+                f"Pins set to {[states[pin] for pin in changed]}", extra={"pins": changed}
+            )
+        return changed
+
+    def activate_line(self, pin: int):
+        if pin not in self.PINLIST:
+            logger.error(f"Can't activate pin {pin}, not in the pin list", extra={"pin": pin})
+            return
+        # Only this line waters, every other pin goes off
+        states = dict.fromkeys(self.PINLIST, False)
+        states[pin] = True
+        self.set_lines(states)
+
+    def deactivate_line(self, pin: int):
+        if pin not in self.PINLIST:
+            logger.error(
+                f"Can't deactivate pin {pin}, not in the pin list", extra={"pin": pin}
+            )
+            return
+        self.set_lines({pin: False})
+
+    def set_polarity(self, active_high: bool):
+        """Switch between active high and active low relays.
+
+        Pins that are already set up are rewritten so each keeps its state.
+        """
+        with self._pin_lock:
+            self.watering_when_GPIO_high = active_high
+            pins = list(self._pin_active)
+            if pins:
+                self.backend.write(pins, [self._level(self._pin_active[pin]) for pin in pins])
+                GPIO_WRITES.inc()
+
+    def get_pin_states(self):
+        """Copy of the shadow register, without touching the hardware."""
+        with self._pin_lock:
+            return dict(self._pin_active)
+
+
+def load_controller(name=None):
+    """A PinController on the backend named by ``name`` or
+    WATERING_PIN_CONTROLLER."""
+    name = name or os.environ.get("WATERING_PIN_CONTROLLER", "gpio")
+    if name == "gpio":
+        backend = GPIOBackend()
+    elif name == "dummy":
+        backend = MemoryBackend()
+    elif name == "file":
+        backend = FileBackend(os.environ.get("WATERING_PIN_FILE", "pins.json"))
+    else:
+        raise ValueError(f"Unknown WATERING_PIN_CONTROLLER {name!r}")
+    logger.info(f"Using the {backend.name} pin backend")
+    return PinController(backend)
@@ -0,0 +1,57 @@
+from array import array
+from bisect import bisect_right
+
+from scheduler import MINUTES_PER_DAY, MINUTES_PER_WEEK
+from utils import mask_to_days
+
+
+class ScheduleWindows:
+    """The weekly watering windows of a set of schedule rows.
+
+    Every window is kept as a ``[start, end)`` pair of minute-of-week
+    integers in flat arrays sorted by start. Only windows that started
+    within the longest window's length of a minute can cover it, so
+    finding the runs that should be on is a bisect for that range and a
+    comparison of each end in it, not a pass over every window. A window
+    that runs past Sunday midnight keeps an end beyond the week instead of
+    being split, so its remaining length comes out whole.
+    """
+
+    def __init__(self, schedules):
+        self.schedules = schedules
+        windows = []
+        for index, schedule_item in enumerate(schedules):
+            start_minute = schedule_item["start_minute"]
+            end_minute = schedule_item["end_minute"]
+            if end_minute <= start_minute:
+                # Runs past midnight, ends on the following day
+                end_minute += MINUTES_PER_DAY
+            for day_index in mask_to_days(schedule_item["repeat_days"]):
+                day_minute = day_index * MINUTES_PER_DAY
+                windows.append((day_minute + start_minute, day_minute + end_minute, index))
+        windows.sort()
+        self.starts = array("i", (start for start, _, _ in windows))
+        self.ends = array("i", (end for _, end, _ in windows))
+        # Index into ``schedules`` of each window
+        self.owners = array("i", (index for _, _, index in windows))
+        self.longest = max((end - start for start, end, _ in windows), default=0)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _covering(self, minute):
+        # Windows starting in (minute - longest, minute] that end after it
+        low = bisect_right(self.starts, minute - self.longest)
+        high = bisect_right(self.starts, minute)
+        return [
+            (self.schedules[self.owners[i]], minute - self.starts[i], self.ends[i] - minute)
+            for i in range(low, high)
+            if self.ends[i] > minute
+        ]
+
+    def active(self, minute):
+        """``(schedule_item, minutes_in, minutes_left)`` for every window
+        covering ``minute``, earliest started first."""
+        # The same minute a week later catches windows carried past Sunday,
+        # which started before any window of this week
+        return self._covering(minute + MINUTES_PER_WEEK) + self._covering(minute)
@@ -0,0 +1,284 @@
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LATENESS = metrics.histogram(
+    "watering_scheduler_lateness_seconds",
+    "How long after their scheduled time jobs fired.",
+    ("job",),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 30, 60, 300),
+)
+
+# Jobs firing more than this many seconds late are logged as warnings
+LATE_WARNING = 5
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+ONE_WEEK = datetime.timedelta(days=7)
+# Tag of the jobs added with Scheduler.once()
+ONCE = "once"
+
+
+def start_of_week(moment):
+    """Midnight on the Monday of the week containing ``moment``."""
+    monday = moment - datetime.timedelta(days=moment.weekday())
+    return monday.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def minute_of_week(moment):
+    """Minutes since Monday 00:00 of the week containing ``moment``."""
+    return moment.weekday() * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+
+
+class Job:
+    """A callback that repeats every week at a fixed minute of the week.
+
+    Minute 0 is Monday 00:00, following ``datetime.weekday()``.
+    """
+
+    def __init__(self, minute_of_week, func, **kwargs):
+        self.minute_of_week = minute_of_week % MINUTES_PER_WEEK
+        self.func = func
+        self.kwargs = kwargs
+        self.next_run = None
+        self.cancelled = False
+        # One-off jobs fire once at ``next_run``, even if that has passed
+        self.repeat = True
+
+    def schedule_next(self, now):
+        """Set ``next_run`` to the first occurrence strictly after ``now``."""
+        if not self.repeat:
+            return
+        if self.next_run is None:
+            self.next_run = start_of_week(now) + datetime.timedelta(
+                minutes=self.minute_of_week
+            )
+        while self.next_run <= now:
+            self.next_run += ONE_WEEK
+
+    def __repr__(self):
+        kwargs = ", ".join(f"{key}={value!r}" for key, value in self.kwargs.items())
+        if not self.repeat:
+            return f"<Job {self.func.__name__}({kwargs}) once at {self.next_run}>"
+        day, minute = divmod(self.minute_of_week, MINUTES_PER_DAY)
+        return (
+            f"<Job {self.func.__name__}({kwargs}) "
+            f"day={day} at {minute // 60:02d}:{minute % 60:02d}>"
+        )
+
+
+class Scheduler:
+    """Runs weekly jobs from a min-heap ordered by their next fire time.
+
+    The worker thread sleeps on a condition variable until the earliest
+    deadline and is woken early whenever the set of jobs changes.
+    """
+
+    # Upper bound on a single sleep so wall clock jumps (NTP sync on a Pi
+    # without an RTC) are noticed within a minute
+    MAX_SLEEP = 60
+
+    def __init__(self, now=datetime.datetime.now):
+        self.now = now
+        self._heap = []
+        self._order = itertools.count()
+        # Jobs grouped by the tag they were added under, e.g. a schedule id
+        self._tags = {}
+        self._live = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def __len__(self):
+        with self._cond:
+            return self._live
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.next_run, next(self._order), job))
+
+    def _insert(self, jobs, now):
+        for job in jobs:
+            job.cancelled = False
+            job.schedule_next(now)
+            self._push(job)
+        self._live += len(jobs)
+
+    def _cancel(self, jobs):
+        for job in jobs:
+            job.cancelled = True
+        self._live -= len(jobs)
+        # Cancelled entries are dropped lazily, compact once they dominate
+        if len(self._heap) > 2 * self._live + 64:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+
+    def add(self, job, tag=None):
+        with self._cond:
+            self._insert([job], self.now())
+            self._tags.setdefault(tag, []).append(job)
+            self._cond.notify()
+        return job
+
+    def once(self, when, func, **kwargs):
+        """Run ``func(**kwargs)`` a single time at the datetime ``when``.
+
+        One-off jobs are kept by ``replace_all()``, they belong to whatever
+        scheduled them rather than to a schedule.
+        """
+        job = Job(0, func, **kwargs)
+        job.next_run = when
+        job.repeat = False
+        return self.add(job, tag=ONCE)
+
+    def replace(self, tag, jobs):
+        """Swap the jobs under ``tag`` for ``jobs`` in one step.
+
+        A tag without jobs is dropped, so it isn't counted by ``tags()``.
+        """
+        with self._cond:
+            self._cancel(self._tags.pop(tag, []))
+            if jobs:
+                self._insert(jobs, self.now())
+                self._tags[tag] = list(jobs)
+            self._cond.notify()
+
+    def remove(self, tag):
+        self.replace(tag, [])
+
+    def replace_all(self, jobs_by_tag):
+        """Rebuild every job at once, without a window where none exist."""
+        with self._cond:
+            once = [job for job in self._tags.get(ONCE, []) if not job.cancelled]
+            self._heap = []
+            self._tags = {}
+            self._live = 0
+            now = self.now()
+            if once:
+                jobs_by_tag = {**jobs_by_tag, ONCE: once}
+            for tag, jobs in jobs_by_tag.items():
+                # Dropped like in replace(), e.g. a schedule with no days
+                if not jobs:
+                    continue
+                self._insert(jobs, now)
+                self._tags[tag] = list(jobs)
+            self._cond.notify()
+
+    def clear(self):
+        with self._cond:
+            self._heap = []
+            self._tags = {}
+            self._live = 0
+            self._cond.notify()
+
+    def tags(self):
+        with self._cond:
+            return [tag for tag in self._tags if tag != ONCE]
+
+    def _peek(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def next_run(self):
+        with self._cond:
+            entry = self._peek()
+            return entry[0] if entry else None
+
+    def _pop_due(self, now):
+        due = []
+        while (entry := self._peek()) and entry[0] <= now:
+            scheduled, _, job = heapq.heappop(self._heap)
+            due.append((scheduled, job))
+            if job.repeat:
+                job.schedule_next(now)
+                self._push(job)
+            else:
+                self._live -= 1
+                once = self._tags[ONCE]
+                once.remove(job)
+                if not once:
+                    del self._tags[ONCE]
+        return due
+
+    def _fire(self, due):
+        for scheduled, job in due:
+            # Jobs due together run one after the other, so later ones in
+            # the batch also wait on the earlier ones
+            now = self.now()
+            lateness = (now - scheduled).total_seconds()
+            LATENESS.observe(lateness, job=job.func.__name__)
+            logger.log(
+                logging.WARNING if lateness > LATE_WARNING else logging.DEBUG,
+                f"{job} fired",
+                extra={
+                    "pin": job.kwargs.get("gpio_pin"),
+                    "line": job.kwargs.get("name"),
+                    "scheduled": scheduled,
+                    "actual": now,
+                    "late_s": round(lateness, 3),
+                },
+            )
+            try:
+                job.func(**job.kwargs)
+            except Exception:
+                logger.exception(f"{job} raised an exception")
+
+    def run_until(self, end, advance):
+        """Fire every job due up to ``end`` in order without sleeping.
+
+        ``advance(moment)`` must move the clock passed as ``now`` forward to
+        ``moment``. It is called with each deadline in turn and finally with
+        ``end``, so weeks of schedules replay as fast as the jobs run.
+        Returns the number of jobs fired.
+        """
+        fired = 0
+        while True:
+            with self._cond:
+                entry = self._peek()
+            if entry is None or entry[0] > end:
+                break
+            advance(entry[0])
+            now = self.now()
+            with self._cond:
+                due = self._pop_due(now)
+            self._fire(due)
+            fired += len(due)
+        advance(end)
+        return fired
+
+    def run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    now = self.now()
+                    entry = self._peek()
+                    if entry and entry[0] <= now:
+                        break
+                    timeout = self.MAX_SLEEP
+                    if entry:
+                        delay = (entry[0] - now).total_seconds()
+                        timeout = min(timeout, delay)
+                    self._cond.wait(timeout)
+                due = self._pop_due(now)
+            self._fire(due)
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
@@ -0,0 +1,89 @@
+import threading
+
+from utils import DATABASE, SQLite
+
+# Every known setting and its default. The default's type decides how the
+# text in the settings table is read: flags are stored as "on"/"off".
+DEFAULTS = {
+    "maintenance_mode": False,
+    # If true, the Pin will be set high during watering.
+    "watering_when_GPIO_high": False,
+    # Total flow the water supply can feed at once, see watering_lines.flow
+    "supply_capacity": 1,
+    # Soil moisture percentages from which runs are shortened or skipped,
+    # 0 switches each off
+    "moisture_shorten": 0,
+    "moisture_skip": 0,
+    # Daily evapotranspiration in mm the schedule lengths were chosen for
+    "reference_et": 5.0,
+}
+
+
+def _parse(default, text):
+    if isinstance(default, bool):
+        return text == "on"
+    return type(default)(text)
+
+
+def _format(value):
+    if isinstance(value, bool):
+        return "on" if value else "off"
+    return str(value)
+
+
+class Settings:
+    """Cached, typed view of the settings table.
+
+    Values are read from the database once and served from memory after
+    that. Every write goes through ``set()``, which updates the table and
+    the cache together and then tells the key's subscribers.
+    """
+
+    def __init__(self, file=DATABASE):
+        self.file = file
+        self._values = None
+        self._subscribers = {}
+        self._lock = threading.RLock()
+
+    def load(self):
+        """(Re)read every setting from the database."""
+        with SQLite(self.file) as db:
+            rows = db.execute("SELECT key, value FROM settings").fetchall()
+        stored = {row["key"]: row["value"] for row in rows}
+        with self._lock:
+            self._values = {
+                key: _parse(default, stored[key]) if key in stored else default
+                for key, default in DEFAULTS.items()
+            }
+
+    def get(self, key):
+        values = self._values
+        if values is None:
+            self.load()
+            values = self._values
+        return values[key]
+
+    def set(self, key, value):
+        if key not in DEFAULTS:
+            raise KeyError(f"Unknown setting {key}")
+        with self._lock:
+            previous = self.get(key)
+            with SQLite(self.file) as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                    (key, _format(value)),
+                )
+            self._values = {**self._values, key: value}
+        if value != previous:
+            for callback in self._subscribers.get(key, []):
+                callback(value)
+        return value
+
+    def toggle(self, key):
+        """Flip a flag setting, returns its new value."""
+        with self._lock:
+            return self.set(key, not self.get(key))
+
+    def subscribe(self, key, callback):
+        """Call ``callback(value)`` whenever ``key`` changes."""
+        self._subscribers.setdefault(key, []).append(callback)
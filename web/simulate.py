@@ -0,0 +1,193 @@
+"""Replay watering schedules over a time range as fast as possible.
+
+Runs the jobs ``load_schedules()`` creates, including the
+``start_watering``/``stop_watering`` callbacks, their maintenance check
+and the supply capacity limits, on a simulated clock against the dummy pin
+controller. Prints the resulting on/off timeline for each line.
+
+Run from the ``web`` directory:
+
+    python simulate.py 2026-04-01 2026-10-01
+    python simulate.py 2026-04-01 2026-04-08 --format json --output week.json
+    python simulate.py 2026-04-01 2026-04-08 --capacity 3
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+
+class SimulatedClock:
+    """A clock that only moves when told to."""
+
+    def __init__(self, start):
+        self.current = start
+
+    def now(self):
+        return self.current
+
+    def advance_to(self, moment):
+        self.current = max(self.current, moment)
+
+
+class Timeline:
+    """Collects on/off periods from pin state changes."""
+
+    def __init__(self, line_names):
+        self.line_names = line_names
+        self.opened = {}
+        self.runs = []
+
+    def record(self, states, moment):
+        for pin, active in states.items():
+            if active and pin not in self.opened:
+                self.opened[pin] = moment
+            elif not active and pin in self.opened:
+                self._close(pin, moment)
+
+    def finish(self, moment):
+        for pin in list(self.opened):
+            self._close(pin, moment)
+
+    def _close(self, pin, moment):
+        started = self.opened.pop(pin)
+        self.runs.append(
+            {
+                "line": self.line_names.get(pin, f"PIN {pin}"),
+                "gpio_pin": pin,
+                "on": started.isoformat(timespec="minutes"),
+                "off": moment.isoformat(timespec="minutes"),
+                "minutes": round((moment - started).total_seconds() / 60, 2),
+            }
+        )
+
+
+def busy_minutes(runs):
+    """Minutes during which at least one line was watering."""
+    total = 0
+    busy_until = None
+    for run in sorted(runs, key=lambda run: run["on"]):
+        on = datetime.datetime.fromisoformat(run["on"])
+        off = datetime.datetime.fromisoformat(run["off"])
+        if busy_until is not None and on < busy_until:
+            on = busy_until
+        if off > on:
+            total += (off - on).total_seconds() / 60
+            busy_until = off
+    return round(total, 2)
+
+
+def simulate(start, end, capacity=None):
+    """Replay ``[start, end)``, returns the timeline and run statistics.
+
+    ``capacity`` overrides the supply_capacity setting. Imports ``main`` on
+    first use, so WATERING_DB and WATERING_PIN_CONTROLLER must already be
+    set.
+    """
+    import main
+    from utils import SQLite
+
+    main.migrate()
+    main.pin_controller.enable_all_lines()
+    with SQLite() as db:
+        lines = db.execute("SELECT name, gpio_pin FROM watering_lines").fetchall()
+
+    # The app's own scheduler on a simulated clock, so runs shifted by the
+    # dispatcher get their one-off stop jobs here too
+    clock = SimulatedClock(start)
+    scheduler = main.scheduler
+    scheduler.now = clock.now
+    main.load_schedules()
+    schedules = len(scheduler.tags())
+    if capacity is None:
+        capacity = main.settings.get("supply_capacity")
+    main.dispatcher.set_capacity(capacity)
+    timeline = Timeline({line["gpio_pin"]: line["name"] for line in lines})
+
+    def advance(moment):
+        # Apply what the jobs at the current instant asked for, then move on.
+        # The actuator worker isn't running, so nothing switches until now.
+        main.actuator.drain()
+        timeline.record(main.pin_controller.get_pin_states(), clock.now())
+        clock.advance_to(moment)
+
+    started = time.perf_counter()
+    fired = scheduler.run_until(end, advance)
+    elapsed = time.perf_counter() - started
+    timeline.finish(end)
+
+    stats = {
+        "schedules": schedules,
+        "jobs": len(scheduler),
+        "fired": fired,
+        "runs": len(timeline.runs),
+        "capacity": capacity,
+        "busy_minutes": busy_minutes(timeline.runs),
+        "elapsed_s": round(elapsed, 4),
+        "jobs_per_s": round(fired / elapsed) if elapsed else None,
+    }
+    return timeline.runs, stats
+
+
+def write_runs(runs, output, format):
+    if format == "json":
+        json.dump(runs, output, indent=2)
+        output.write("\n")
+        return
+    writer = csv.DictWriter(output, ["line", "gpio_pin", "on", "off", "minutes"])
+    writer.writeheader()
+    writer.writerows(runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("start", type=datetime.datetime.fromisoformat)
+    parser.add_argument("end", type=datetime.datetime.fromisoformat)
+    parser.add_argument("--database", default="watering_system.db")
+    parser.add_argument(
+        "--capacity", type=int, help="supply capacity, default the saved setting"
+    )
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("--output", help="file for the timeline, default stdout")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        parser.error(f"no database at {args.database}")
+    os.environ["WATERING_PIN_CONTROLLER"] = "dummy"
+    logging.disable(logging.INFO)
+
+    # Replay a copy, so migrations and anything written while replaying
+    # never touch the live database
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, "simulate.db")
+        source = sqlite3.connect(args.database)
+        target = sqlite3.connect(copy)
+        source.backup(target)
+        source.close()
+        target.close()
+        os.environ["WATERING_DB"] = copy
+        runs, stats = simulate(args.start, args.end, args.capacity)
+
+    if args.output:
+        with open(args.output, "w", newline="") as output:
+            write_runs(runs, output, args.format)
+    else:
+        write_runs(runs, sys.stdout, args.format)
+    print(
+        f"Replayed {args.start} to {args.end}: {stats['fired']} jobs fired from "
+        f"{stats['schedules']} schedules, {stats['runs']} runs watering for "
+        f"{stats['busy_minutes']} minutes at capacity {stats['capacity']}, "
+        f"{stats['elapsed_s']}s ({stats['jobs_per_s']} jobs/s)",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
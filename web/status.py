@@ -0,0 +1,149 @@
+import datetime
+import threading
+import uuid
+
+IDLE = "Idle"
+WATERING = "Watering"
+WAITING = "Waiting for supply"
+
+
+class LineStatus:
+    """What one watering line is doing and when it next starts and stops."""
+
+    __slots__ = ("line_id", "name", "gpio_pin", "state", "until", "next_start", "next_stop")
+
+    def __init__(self, line_id, name, gpio_pin):
+        self.line_id = line_id
+        self.name = name
+        self.gpio_pin = gpio_pin
+        self.state = IDLE
+        self.until = None
+        self.next_start = None
+        self.next_stop = None
+
+    def to_dict(self):
+        return {
+            "id": self.line_id,
+            "name": self.name,
+            "gpio_pin": self.gpio_pin,
+            "state": self.state,
+            "until": self.until.isoformat() if self.until else None,
+            "next_start": self.next_start.isoformat() if self.next_start else None,
+            "next_stop": self.next_stop.isoformat() if self.next_stop else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """The inverse of ``to_dict()``, for status sent between processes."""
+        line = cls(data["id"], data["name"], data["gpio_pin"])
+        line.state = data["state"]
+        for field in ("until", "next_start", "next_stop"):
+            if data[field]:
+                setattr(line, field, datetime.datetime.fromisoformat(data[field]))
+        return line
+
+
+class StatusIndex:
+    """Each line's state and next start and stop, kept up to date as jobs
+    fire and schedules change so reading it never walks the schedules.
+
+    ``version`` goes up with every change and ``instance`` tells this
+    process's index from one before a restart, together an ETag.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.instance = uuid.uuid4().hex[:8]
+        self._lines = {}
+        # schedule id -> (line id, start jobs, stop jobs)
+        self._schedules = {}
+        self._line_schedules = {}
+        self._lock = threading.Lock()
+
+    def set_lines(self, lines):
+        """Replace the known lines with ``(id, name, gpio_pin)`` tuples,
+        keeping the state of lines that still exist."""
+        with self._lock:
+            previous = self._lines
+            self._lines = {}
+            for line_id, name, gpio_pin in lines:
+                line = previous.get(line_id) or LineStatus(line_id, name, gpio_pin)
+                line.name = name
+                line.gpio_pin = gpio_pin
+                self._lines[line_id] = line
+                self._refresh(line_id)
+            self.version += 1
+
+    def set_schedule(self, schedule_id, line_id=None, starts=(), stops=()):
+        """Track the jobs of one schedule, or forget it if there are none.
+
+        The jobs must already be in the scheduler, so their ``next_run`` is
+        set.
+        """
+        with self._lock:
+            self._set_schedule(schedule_id, line_id, starts, stops)
+            self.version += 1
+
+    def replace_all(self, schedules):
+        """Track ``{schedule_id: (line_id, starts, stops)}`` instead of
+        everything tracked so far."""
+        with self._lock:
+            self._schedules = {}
+            self._line_schedules = {}
+            for schedule_id, (line_id, starts, stops) in schedules.items():
+                self._schedules[schedule_id] = (line_id, starts, stops)
+                self._line_schedules.setdefault(line_id, set()).add(schedule_id)
+            for line_id in self._lines:
+                self._refresh(line_id)
+            self.version += 1
+
+    def _set_schedule(self, schedule_id, line_id, starts, stops):
+        old = self._schedules.pop(schedule_id, None)
+        if old is not None:
+            self._line_schedules[old[0]].discard(schedule_id)
+            self._refresh(old[0])
+        if starts or stops:
+            self._schedules[schedule_id] = (line_id, starts, stops)
+            self._line_schedules.setdefault(line_id, set()).add(schedule_id)
+            self._refresh(line_id)
+
+    def job_fired(self, line_id):
+        """A start or stop job of ``line_id`` ran and moved to its next week."""
+        with self._lock:
+            self._refresh(line_id)
+            self.version += 1
+
+    def set_state(self, line_id, state, until=None):
+        with self._lock:
+            line = self._lines.get(line_id)
+            if line is not None:
+                line.state = state
+                line.until = until
+                self.version += 1
+
+    def reset_states(self):
+        """Every line idle, e.g. when maintenance mode switches them off."""
+        with self._lock:
+            for line in self._lines.values():
+                line.state = IDLE
+                line.until = None
+            self.version += 1
+
+    def _refresh(self, line_id):
+        line = self._lines.get(line_id)
+        if line is None:
+            return
+        starts = []
+        stops = []
+        for schedule_id in self._line_schedules.get(line_id, ()):
+            _, schedule_starts, schedule_stops = self._schedules[schedule_id]
+            starts.extend(job.next_run for job in schedule_starts)
+            stops.extend(job.next_run for job in schedule_stops)
+        line.next_start = min(starts, default=None)
+        line.next_stop = min(stops, default=None)
+
+    def lines(self):
+        """``(version, [LineStatus, ...])`` ordered by name. The entries are
+        the index's own, treat them as read only."""
+        with self._lock:
+            return self.version, sorted(self._lines.values(), key=lambda line: line.name)
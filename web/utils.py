@@ -1,22 +1,95 @@
 import sqlite3
 import datetime
 import calendar
+import os
+import queue
+import threading
+import time
+
+import metrics
 
 # Path to your SQLite database file
-DATABASE = "watering_system.db"
+DATABASE = os.environ.get("WATERING_DB", "watering_system.db")
+
+# How many connections each database file keeps open for reuse
+POOL_SIZE = 4
+# Seconds to wait for a connection when all of them are in use
+POOL_TIMEOUT = 30
 
+# Milliseconds a statement waits on a locked database before giving up
+BUSY_TIMEOUT_MS = 5000
+# Longest pause between tries of a statement while the database is locked
+BUSY_RETRY_MAX_MS = 50
 
-def get_now_time():
-    return datetime.datetime.now().strftime('%H:%M')
+# Day abbreviations used by the forms, indexed like datetime.weekday()
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
 
 
 def get_today_str():
     return calendar.day_abbr[datetime.datetime.now().weekday()]
 
 
-def run_now(start_time, end_time):
-    current_time = get_now_time()
-    return sorted([start_time, current_time, end_time])[1] == current_time
+def time_to_minute(time_str):
+    """Minutes since midnight for an "HH:MM" string."""
+    hours, minutes = time_str.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def minute_to_time(minute):
+    """Format minutes since midnight as an "HH:MM" string."""
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def days_to_mask(days):
+    """repeat_days bitmask for day abbreviations, Monday in bit 0."""
+    return sum(1 << index for index, day in enumerate(DAYS) if day in days)
+
+
+def mask_to_days(mask):
+    """``datetime.weekday()`` numbers set in a repeat_days bitmask."""
+    return [index for index in range(len(DAYS)) if mask >> index & 1]
+
+
+SQLITE_CONNECTIONS = metrics.counter(
+    "watering_sqlite_connections_opened_total",
+    "Connections opened by the SQLite pool.",
+)
+SQLITE_SESSIONS = metrics.histogram(
+    "watering_sqlite_session_seconds",
+    "Time each with SQLite() block held a connection.",
+)
+SQLITE_QUERIES = metrics.histogram(
+    "watering_sqlite_query_seconds",
+    "Time spent executing statements, by statement type.",
+    ("statement",),
+)
+SQLITE_BUSY_RETRIES = metrics.counter(
+    "watering_sqlite_busy_retries_total",
+    "Statements tried again because another connection held the database lock.",
+    ("statement",),
+)
+SQLITE_BUSY_ERRORS = metrics.counter(
+    "watering_sqlite_busy_errors_total",
+    "Statements that gave up on a locked database after BUSY_TIMEOUT_MS.",
+    ("statement",),
+)
+
+STATEMENT_TYPES = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+def statement_type(sql):
+    words = sql.split(None, 1)
+    verb = words[0].upper() if words else ""
+    return verb if verb in STATEMENT_TYPES else "OTHER"
+
+
+def is_busy(error):
+    """True for "database is locked", but not for a stale read snapshot,
+    which trying again within the same transaction can't fix."""
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF == sqlite3.SQLITE_BUSY and code != sqlite3.SQLITE_BUSY_SNAPSHOT
+    return "database is locked" in str(error)
 
 
 def dict_factory(cursor, row):
@@ -24,21 +97,183 @@ def dict_factory(cursor, row):
     return {key: value for key, value in zip(fields, row)}
 
 
+class TimedConnection:
+    """Wraps a sqlite3 connection to record how long statements take.
+
+    Statements that find the database locked by another connection are
+    tried again with a growing pause for up to ``BUSY_TIMEOUT_MS``, in
+    place of SQLite's own busy handler, so every wait is counted.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def execute(self, sql, parameters=()):
+        return self._run(self._conn.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not isinstance(seq_of_parameters, (list, tuple)):
+            # A generator would be used up by a try that found the lock taken
+            seq_of_parameters = list(seq_of_parameters)
+        return self._run(self._conn.executemany, sql, seq_of_parameters)
+
+    def _run(self, method, sql, parameters):
+        statement = statement_type(sql)
+        started = time.perf_counter()
+        pause = 0.001
+        try:
+            while True:
+                try:
+                    return method(sql, parameters)
+                except sqlite3.OperationalError as e:
+                    if not is_busy(e):
+                        raise
+                    if time.perf_counter() - started > BUSY_TIMEOUT_MS / 1000:
+                        SQLITE_BUSY_ERRORS.inc(statement=statement)
+                        raise
+                SQLITE_BUSY_RETRIES.inc(statement=statement)
+                time.sleep(pause)
+                pause = min(pause * 2, BUSY_RETRY_MAX_MS / 1000)
+        finally:
+            SQLITE_QUERIES.observe(time.perf_counter() - started, statement=statement)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class ConnectionPool:
+    """Bounded pool of open connections to one SQLite database file.
+
+    Connections are opened lazily in WAL mode with a busy timeout, handed
+    out to one thread at a time and kept open between requests.
+    """
+
+    def __init__(self, file, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.file = file
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # No busy timeout, TimedConnection retries statements on a locked
+        # database itself
+        raw = sqlite3.connect(self.file, timeout=0, check_same_thread=False)
+        raw.row_factory = dict_factory
+        conn = TimedConnection(raw)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        SQLITE_CONNECTIONS.inc()
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if not can_open:
+            # Pool exhausted, wait for another thread to hand one back
+            try:
+                return self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise sqlite3.OperationalError(
+                    f"No free connection to {self.file} after {self.timeout}s"
+                )
+        try:
+            return self._connect()
+        except sqlite3.Error:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    def release(self, conn):
+        self._idle.put(conn)
+
+    def discard(self, conn):
+        """Close a connection that can't be reused and free its slot."""
+        try:
+            conn.close()
+        finally:
+            with self._lock:
+                self._opened -= 1
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self.discard(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# The connection each thread is currently using, so nested blocks share it
+_local = threading.local()
+
+
+def get_pool(file=DATABASE):
+    with _pools_lock:
+        pool = _pools.get(file)
+        if pool is None:
+            pool = _pools[file] = ConnectionPool(file)
+        return pool
+
+
+def close_all_connections():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+
 # Context manager to get a connection cursor to the SQLite3 database
 class SQLite:
     def __init__(self, file=DATABASE):
         self.file = file
+        self.conn = None
 
     def __enter__(self):
-        try:
-            self.conn = sqlite3.connect(self.file)
-            self.conn.row_factory = dict_factory
+        held = getattr(_local, "held", None)
+        if held is None:
+            held = _local.held = {}
+        if self.file in held:
+            # Nested block on this thread, reuse its open transaction
+            self.conn, depth = held[self.file]
+            held[self.file] = (self.conn, depth + 1)
             return self.conn
+        try:
+            self.conn = get_pool(self.file).acquire()
         except sqlite3.Error as e:
             raise RuntimeError(f"Database connection failed: {e}")
+        held[self.file] = (self.conn, 1)
+        self.started = time.perf_counter()
+        return self.conn
 
     def __exit__(self, type, value, traceback):
-        if self.conn:
+        if not self.conn:
+            return
+        held = _local.held
+        conn, depth = held[self.file]
+        if depth > 1:
+            held[self.file] = (conn, depth - 1)
+            return
+        del held[self.file]
+        pool = get_pool(self.file)
+        try:
             if traceback is None:  # Commit only if no exception occurred
-                self.conn.commit()
-            self.conn.close()
+                conn.commit()
+            else:
+                conn.rollback()
+        except sqlite3.Error:
+            pool.discard(conn)
+            raise
+        finally:
+            SQLITE_SESSIONS.observe(time.perf_counter() - self.started)
+        pool.release(conn)
@@ -0,0 +1,144 @@
+"""Seasonal run lengths from a local daily weather feed.
+
+The feed, named by WATERING_WEATHER_FEED, is a CSV file or a JSON list of
+days with the reference evapotranspiration ``et0`` and optional ``rain``,
+both in mm:
+
+    date,et0,rain
+    2026-07-01,6.2,0
+    2026-07-02,3.1,4.5
+
+On a day in the feed every run waters for its scheduled length times
+
+    max(0, et0 * crop_coefficient - rain) / reference_et
+
+capped at MAX_FACTOR, where reference_et is the daily ET the schedule
+lengths were chosen for. A factor of 0 skips the run. Days missing from
+the feed, or no feed at all, keep the scheduled lengths.
+"""
+
+import csv
+import datetime
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+FEED = os.environ.get("WATERING_WEATHER_FEED")
+
+# Hot days lengthen runs, but never past twice their scheduled length
+MAX_FACTOR = 2.0
+
+
+def read_feed(path):
+    """``{date: (et0, rain)}`` from a CSV or JSON weather feed."""
+    with open(path, newline="") as file:
+        if path.endswith(".json"):
+            rows = json.load(file)
+        else:
+            rows = list(csv.DictReader(file))
+    days = {}
+    for number, row in enumerate(rows, start=1):
+        try:
+            day = datetime.date.fromisoformat(str(row["date"]))
+            days[day] = (float(row["et0"]), float(row.get("rain") or 0))
+        except (KeyError, TypeError, ValueError):
+            logger.warning(f"Skipped row {number} of weather feed {path}")
+    return days
+
+
+class WeatherAdjuster:
+    """Today's adjusted length of every schedule's runs.
+
+    The lengths for a day are computed for all schedules at once, in a
+    single loop over them, and kept until the day, the schedules or the
+    feed's modification time change. Runs only look theirs up.
+    """
+
+    def __init__(self, path=FEED, reference_et=5.0):
+        self.path = path
+        self.reference_et = reference_et
+        self._feed = {}
+        self._feed_mtime = None
+        # schedule id -> (minutes, crop_coefficient)
+        self._schedules = {}
+        self._day = None
+        self._minutes = {}
+        self._lock = threading.Lock()
+
+    def set_schedules(self, schedules):
+        """Replace every schedule, from SCHEDULE_JOBS_QUERY rows."""
+        with self._lock:
+            self._schedules = {
+                schedule_item["id"]: self._entry(schedule_item) for schedule_item in schedules
+            }
+            self._day = None
+
+    def set_schedule(self, schedule_id, schedule_item=None):
+        """Add, replace or with no row remove one schedule."""
+        with self._lock:
+            if schedule_item is None:
+                self._schedules.pop(schedule_id, None)
+            else:
+                self._schedules[schedule_id] = self._entry(schedule_item)
+            self._day = None
+
+    def set_reference_et(self, reference_et):
+        with self._lock:
+            self.reference_et = reference_et
+            self._day = None
+
+    def minutes(self, schedule_id, day, default):
+        """Adjusted length of ``schedule_id``'s runs on ``day``, ``default``
+        for schedules or days the feed doesn't cover."""
+        with self._lock:
+            # Only a stat, the feed may be updated during the day
+            self._refresh_feed()
+            if day != self._day:
+                self._compute(day)
+            return self._minutes.get(schedule_id, default)
+
+    def factors(self, day):
+        """``(et0, rain)`` of ``day`` in the feed, None if it's missing."""
+        with self._lock:
+            self._refresh_feed()
+            return self._feed.get(day)
+
+    def _entry(self, schedule_item):
+        start_minute = schedule_item["start_minute"]
+        end_minute = schedule_item["end_minute"]
+        if end_minute <= start_minute:
+            end_minute += 24 * 60
+        return end_minute - start_minute, schedule_item["crop_coefficient"]
+
+    def _refresh_feed(self):
+        """Reread the feed if the file changed since it was last read."""
+        if not self.path:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime != self._feed_mtime:
+                self._feed = read_feed(self.path)
+                self._feed_mtime = mtime
+                self._day = None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Can't read weather feed {self.path}: {e}")
+
+    def _compute(self, day):
+        self._day = day
+        self._minutes = {}
+        weather = self._feed.get(day)
+        if weather is None or self.reference_et <= 0:
+            return
+        et0, rain = weather
+        scheduled = 0
+        for schedule_id, (length, coefficient) in self._schedules.items():
+            factor = max(0.0, et0 * coefficient - rain) / self.reference_et
+            self._minutes[schedule_id] = round(length * min(MAX_FACTOR, factor))
+            scheduled += length
+        logger.info(
+            f"Run lengths for {day} from {et0}mm ET and {rain}mm rain, "
+            f"{sum(self._minutes.values())} of {scheduled} scheduled minutes"
+        )
@@ -0,0 +1,14 @@
+"""WSGI entry point that serves the app from several worker processes.
+
+Each worker leaves the scheduler and the relays to the one controller
+process (controller.py) and sends it commands over WATERING_CONTROL_SOCKET.
+Start the controller first, then from the ``web`` directory:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+import os
+
+os.environ["WATERING_ROLE"] = "web"
+
+from main import app  # noqa: E402
@@ -0,0 +1,216 @@
+import datetime
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+STARTED = "started"
+STOPPED = "stopped"
+
+RUNS_QUEUED = metrics.counter(
+    "watering_runs_queued_total",
+    "Scheduled runs that had to wait for supply capacity.",
+)
+QUEUE_WAIT = metrics.histogram(
+    "watering_run_queue_wait_seconds",
+    "How long queued runs waited before their valve opened.",
+    buckets=(1, 10, 60, 300, 900, 1800, 3600, 7200),
+)
+
+
+class Run:
+    """One scheduled watering of a line, waiting or in progress."""
+
+    def __init__(self, pin, name, flow, minutes, requested, line_id=None, schedule_id=None):
+        self.pin = pin
+        self.line_id = line_id
+        self.schedule_id = schedule_id
+        self.name = name
+        self.flow = flow
+        self.minutes = minutes
+        self.requested = requested
+        self.started = None
+        # Waited for capacity, so it starts later than scheduled
+        self.queued = False
+        # Ends after ``minutes`` rather than at its schedule's stop job, e.g.
+        # shortened for damp soil or lengthened on a hot day
+        self.timed = False
+
+
+class ZoneDispatcher:
+    """Opens the valves of scheduled runs within the supply capacity.
+
+    Each line draws its flow from a supply of ``capacity``, so lines run
+    side by side while their total flow fits. A run that would exceed it
+    waits and starts as soon as enough flow is free. A run that starts late
+    keeps its full length and is stopped by a one-off scheduler job instead
+    of its usual stop job.
+    """
+
+    def __init__(self, actuator, scheduler, capacity=1):
+        self.actuator = actuator
+        self.scheduler = scheduler
+        self.capacity = capacity
+        self._running = {}
+        self._waiting = []
+        # When each pin's last run opened its valve
+        self._last_started = {}
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """Call ``callback(event, run, at)`` when a run is QUEUED, STARTED
+        or STOPPED."""
+        self._subscribers.append(callback)
+
+    def active_flow(self):
+        return sum(run.flow for run in self._running.values())
+
+    def _fits(self, flow):
+        # A line drawing more than the whole supply still gets to run alone
+        used = self.active_flow()
+        return used == 0 or used + flow <= self.capacity
+
+    def start(
+        self, pin, name, flow=1, minutes=None, line_id=None, timed=False, schedule_id=None
+    ):
+        """Open ``pin`` now if the supply allows, otherwise queue the run.
+
+        A ``timed`` run is stopped after ``minutes`` rather than by its
+        schedule. Returns True if the valve was opened.
+        """
+        with self._lock:
+            if pin in self._running or any(run.pin == pin for run in self._waiting):
+                return False
+            run = Run(pin, name, flow, minutes, self.scheduler.now(), line_id, schedule_id)
+            run.timed = timed
+            if self._fits(flow):
+                self._open(run)
+                return True
+            run.queued = True
+            self._waiting.append(run)
+            self._notify(QUEUED, run, run.requested)
+        RUNS_QUEUED.inc()
+        logger.info(
+            f"Queued, {flow} flow would exceed the supply capacity of {self.capacity}",
+            extra={"pin": pin, "line": name, "action": "queue"},
+        )
+        return False
+
+    def stop(self, pin):
+        """Handle the scheduled end of the run on ``pin``.
+
+        Returns True if the valve was closed. Runs that started late or are
+        timed, or are still waiting, carry on for their full length.
+        """
+        with self._lock:
+            run = self._running.get(pin)
+            if run is None or ((run.queued or run.timed) and run.minutes is not None):
+                return False
+            self._close(run)
+        return True
+
+    def cancel(self, pin):
+        """End the run on ``pin`` now, however it was started, or drop it
+        from the queue. Returns True if there was one."""
+        with self._lock:
+            run = self._running.get(pin)
+            if run is not None:
+                self._close(run)
+                return True
+            for run in self._waiting:
+                if run.pin == pin:
+                    self._waiting.remove(run)
+                    self._notify(STOPPED, run, self.scheduler.now())
+                    return True
+        return False
+
+    def runs(self):
+        """Every run in progress or waiting."""
+        with self._lock:
+            return list(self._running.values()) + list(self._waiting)
+
+    def finish(self, run):
+        """End a shifted or timed run, the callback of its one-off stop job."""
+        with self._lock:
+            if self._running.get(run.pin) is run:
+                self._close(run)
+
+    def started_since(self, pin, moment):
+        """True if a run on ``pin`` opened its valve at or after ``moment``."""
+        with self._lock:
+            started = self._last_started.get(pin)
+            return started is not None and started >= moment
+
+    def set_capacity(self, capacity):
+        with self._lock:
+            self.capacity = capacity
+            self._start_waiting()
+
+    def clear(self):
+        """Forget every run without switching anything."""
+        with self._lock:
+            now = self.scheduler.now()
+            for run in self._running.values():
+                self._notify(STOPPED, run, now)
+            self._running.clear()
+            self._waiting.clear()
+
+    def status(self):
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "active_flow": self.active_flow(),
+                "running": sorted(self._running),
+                "waiting": [run.pin for run in self._waiting],
+            }
+
+    def _open(self, run):
+        now = self.scheduler.now()
+        run.started = now
+        self._running[run.pin] = run
+        self._last_started[run.pin] = now
+        self.actuator.open_line(run.pin)
+        self._notify(STARTED, run, now)
+        if run.queued:
+            QUEUE_WAIT.observe((now - run.requested).total_seconds())
+            logger.info(
+                "Started queued run",
+                extra={
+                    "pin": run.pin,
+                    "line": run.name,
+                    "action": "start",
+                    "scheduled": run.requested,
+                    "actual": now,
+                },
+            )
+        if (run.queued or run.timed) and run.minutes is not None:
+            self.scheduler.once(
+                now + datetime.timedelta(minutes=run.minutes),
+                self.finish,
+                run=run,
+            )
+
+    def _close(self, run):
+        del self._running[run.pin]
+        self.actuator.deactivate_line(run.pin)
+        self._notify(STOPPED, run, self.scheduler.now())
+        self._start_waiting()
+
+    def _notify(self, event, run, at):
+        for callback in self._subscribers:
+            callback(event, run, at)
+
+    def _start_waiting(self):
+        # First fit in arrival order, so small runs fill gaps a large run
+        # waiting ahead of them can't use
+        waiting = []
+        for run in self._waiting:
+            if self._fits(run.flow):
+                self._open(run)
+            else:
+                waiting.append(run)
+        self._waiting = waiting